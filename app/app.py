@@ -1,17 +1,27 @@
+import base64
+import collections
+import contextlib
 import copy
 import logging
 import json
+import os
+import threading
+import uuid
 
 import dash
 import dash_bootstrap_components as dbc
 import dash_core_components as dcc
 import dash_html_components as html
+import numpy as np
 import plotly.graph_objs as go
-from dash.dependencies import Input, Output, State
+from dash.dependencies import ClientsideFunction, Input, Output, State
+from dash.exceptions import PreventUpdate
 
 from components import navbar as _navbar
 from components import alert as _alert
+from jobs import JobManager
 from models import Schelling
+from store import SessionLocks, make_store
 
 logging.basicConfig()
 logger = logging.getLogger('app')
@@ -26,6 +36,8 @@ PRE_DEFINED_HEIGHT = 20
 PRE_DEFINED_EMPTY_HOUSE_RATE = 0.2
 PRE_DEFINED_THRESHOLD = 0.6
 PRE_DEFINED_ETHICAL = 2
+PRE_DEFINED_HISTORY = os.environ.get("SCHELLING_HISTORY", "delta")
+PRE_DEFINED_PLATEAU_WINDOW = 10
 
 # Inithialize the model
 model_param = {
@@ -34,15 +46,43 @@ model_param = {
     "empty_house_rate": PRE_DEFINED_EMPTY_HOUSE_RATE,
     "neighbour_similarity": PRE_DEFINED_THRESHOLD,
     "n_iterations": PRE_DEFINED_MAX_ITERATIONS,
-    "races": PRE_DEFINED_ETHICAL
+    "races": PRE_DEFINED_ETHICAL,
+    "history": PRE_DEFINED_HISTORY,
+    "cycle_detection": True,
+    "plateau_window": PRE_DEFINED_PLATEAU_WINDOW
     }
 
+# models of the sessions are kept on the server,
+# the browser only holds the session id
+SESSION_STORE = make_store()
+# the requests of a session load, change and save its model one at a time
+SESSION_LOCKS = SessionLocks()
+# models by session token, see _load_model
+MAX_LOADED_MODELS = 64
+LOADED_MODELS = collections.OrderedDict()
+LOADED_MODELS_LOCK = threading.Lock()
+# heatmaps rendered on the server by (session, run, step), see _server_figure
+MAX_CACHED_FIGURES = 256
+CACHED_FIGURES = collections.OrderedDict()
+CACHED_FIGURES_LOCK = threading.Lock()
+# largest number of labelled steps of the slider, see _slider_marks
+MAX_SLIDER_MARKS = 20
+# largest number of cells on a side of the heatmaps sent to the browser,
+# larger grids are downsampled, see _heatmap_grid
+MAX_HEATMAP_SIDE = int(os.environ.get("SCHELLING_MAX_HEATMAP_SIDE", 200))
+# background jobs running the models to equilibrium
+JOBS = JobManager(
+    SESSION_STORE,
+    max_workers=int(os.environ.get("SCHELLING_JOB_WORKERS", 2)),
+    locks=SESSION_LOCKS
+    )
+
 SCHELLING_MODEL = Schelling(model_param)
 
 SCHELLING_MODEL.initialize()
 CURRENT_ITERATION = SCHELLING_MODEL.current_iteration
 MAX_ITERATIONS = SCHELLING_MODEL.n_iterations
-CURRENT_DATA = SCHELLING_MODEL.data.get(CURRENT_ITERATION)
+CURRENT_DATA = SCHELLING_MODEL.frame(CURRENT_ITERATION)
 
 logger.debug(
     "number of iteractions: {}".format(SCHELLING_MODEL.n_iterations)
@@ -53,7 +93,7 @@ logger.debug(
 )
 logger.debug("final agents: {}".format(SCHELLING_MODEL.agents))
 logger.debug("final grid: {}".format(
-    SCHELLING_MODEL.data.get(SCHELLING_MODEL.current_iteration)
+    SCHELLING_MODEL.frame(SCHELLING_MODEL.current_iteration)
 ))
 
 external_stylesheets = ['https://codepen.io/chriddyp/pen/bWLwgP.css']
@@ -117,11 +157,27 @@ body = dbc.Container(
             [
                 dbc.Col(
                     [
+                        dbc.Checklist(
+                            id="playback-mode",
+                            options=[{"label": "Play in the browser", "value": "browser"}],
+                            value=["browser"],
+                            switch=True,
+                            inline=True
+                            ),
+                        # scrubbing and playing the frames sent once, see assets/playback.js
+                        dcc.Graph(
+                            id='graph-playback',
+                            config={
+                                'displayModeBar': False
+                            }),
                         dcc.Graph(
                             id='graph-with-slider',
                             config={
                                 'displayModeBar': False
                             }),
+                        dcc.Store(id="playback-chunk"),
+                        dcc.Store(id="playback-cursor"),
+                        dcc.Store(id="playback-frames"),
                     ],
                     md=8,
                 ),
@@ -139,9 +195,24 @@ body = dbc.Container(
                                 'displayModeBar': False
                             }
                         ),
+                        # points of the graphs the browser has, see update_model_views
+                        dcc.Store(id="series-cursor"),
                         html.P("Parameters"),
                         param_controls,
                         dbc.Button("Evolve One Step", id="model-calculate", color="primary"),
+                        dbc.Button(
+                            "Run to Equilibrium", id="model-run",
+                            color="secondary", className="ml-2"
+                            ),
+                        dbc.Button(
+                            "Cancel", id="model-cancel",
+                            color="danger", className="ml-2"
+                            ),
+                        html.P(id="job-status", className="mt-2"),
+                        dcc.Interval(
+                            id="job-interval", interval=1000,
+                            n_intervals=0, disabled=True
+                            ),
                     ]
                 ),
             ], className="row", style={'textAlign': "center"}
@@ -155,8 +226,9 @@ body = dbc.Container(
                     value=SLIDER_MAX,
                     marks={i: '{}'.format(i) if i == 1 else str(i)
                         for i in range(SLIDER_MAX+1)},
-                    step=None
-                )]
+                    step=1
+                )],
+                id="step-slider-col"
             )
         ],  style={'textAlign': "center", "marginBottom": "2em", "marginTop": "2em"}
         ),
@@ -167,36 +239,173 @@ body = dbc.Container(
 hidden_elem = html.P(id="hidden-div", style={"display":"none"})
 hidden_elem_calculate = html.P(id="hidden-div-calculate", style={"display":"none"})
 
-model_state_div = html.Div(
-    json.dumps(SCHELLING_MODEL.model_state()),
-    id='intermediate-model-state', style={'display': 'none'})
 
-copy_model_state_div = html.Div(
-    json.dumps(SCHELLING_MODEL.model_state()),
-    id='intermediate-model-state-copy', style={'display': 'none'})
+def _session_token(session_id, version):
+    """
+    _session_token is what the browser keeps in the hidden divs.
+    The version changes on every update so that the callbacks are fired.
+    """
+    return json.dumps({"session": session_id, "version": version})
+
+
+def _load_model(token):
+    """
+    _load_model returns the model of the session in the token.
+    A new model is started if the session has expired.
+
+    The token changes whenever the model is updated, so the models are
+    also kept by token for the callbacks that read the same state.
+    """
+    with LOADED_MODELS_LOCK:
+        if token in LOADED_MODELS:
+            LOADED_MODELS.move_to_end(token)
+            return LOADED_MODELS[token]
+
+    session_id = json.loads(token).get("session")
+    schelling_model = SESSION_STORE.get(session_id)
+    if schelling_model is None:
+        logger.debug("session {} not found, starting a new model".format(session_id))
+        schelling_model = Schelling(model_param)
+        schelling_model.initialize()
+        SESSION_STORE.set(session_id, schelling_model)
+
+    with LOADED_MODELS_LOCK:
+        LOADED_MODELS[token] = schelling_model
+        while len(LOADED_MODELS) > MAX_LOADED_MODELS:
+            LOADED_MODELS.popitem(last=False)
+
+    return schelling_model
+
+
+@contextlib.contextmanager
+def _locked_model(token):
+    """
+    _locked_model holds the lock of the session of the token while the
+    model of the session is used, see :func:`_load_model`
+    """
+    with SESSION_LOCKS(json.loads(token).get("session")):
+        yield _load_model(token)
+
+
+def serve_layout():
+    """
+    serve_layout starts a new session for each page load
+    """
+    session_id = uuid.uuid4().hex
+    schelling_model = Schelling(model_param)
+    schelling_model.initialize()
+    SESSION_STORE.set(session_id, schelling_model)
+
+    model_state_div = html.Div(
+        _session_token(session_id, 0),
+        id='intermediate-model-state', style={'display': 'none'})
+
+    copy_model_state_div = html.Div(
+        _session_token(session_id, 0),
+        id='intermediate-model-state-copy', style={'display': 'none'})
+
+    return html.Div([_navbar, body, hidden_elem, hidden_elem_calculate, model_state_div, copy_model_state_div])
+
 
 app = dash.Dash(__name__, external_stylesheets=[dbc.themes.BOOTSTRAP])
 server = app.server
 app.config.suppress_callback_exceptions = True
 
-app.layout = html.Div([_navbar, body, hidden_elem, hidden_elem_calculate, model_state_div, copy_model_state_div])
+app.layout = serve_layout
 app.title = "Schelling's Segregation Model"
 
-@app.callback(
-    Output('graph-with-slider', 'figure'),
-    [Input('step-slider', 'value')],
-    [State('intermediate-model-state', 'children')])
-def update_figure(selected_step, model):
-    logger.debug(selected_step)
-
-    model = json.loads(model)
-    # schelling_model = Schelling(model)
-    logger.debug("model: {}".format(model))
-    logger.debug('selected step: {}'.format(selected_step))
-    current_data = model.get("data").get(f'{selected_step}')
-    logger.debug("current model: {}; {}".format(model.get("data"), current_data))
+def _display_grid(schelling_model, step):
+    """
+    _display_grid returns the frame of a step as an array of shape
+    (height, width), the same as the 2d list of :meth:`Schelling.frame`
+    but without building the list for the histories that hold arrays
+    """
+    if schelling_model.history != "full":
+        lattice = schelling_model.grid(step)
+        if lattice is not None:
+            width, height = schelling_model.width, schelling_model.height
+            grid = np.zeros((height, width), dtype=np.uint8)
+            # rows are indexed by x, the same as Schelling._lattice_to_2d_array
+            size = min(width, height)
+            grid[:size, :size] = lattice[:size, :size]
+            return grid
+
+    return np.asarray(schelling_model.frame(step), dtype=np.uint8)
+
+
+def _downsample(grid, races, block):
+    """
+    _downsample replaces each square block of cells of the grid by the
+    race of most of its agents, the lowest race on ties and 0 if the
+    block has no agents. The blocks on the edges may be smaller.
+
+    :param grid: array of races
+    :type grid: numpy.ndarray
+    :param races: number of races
+    :type races: int
+    :param block: side of the blocks
+    :type block: int
+    :rtype: numpy.ndarray
+    """
+    rows, columns = grid.shape
+    block_rows, block_columns = -(-rows // block), -(-columns // block)
+    padded = np.zeros((block_rows * block, block_columns * block), dtype=grid.dtype)
+    padded[:rows, :columns] = grid
+    blocks = padded.reshape(block_rows, block, block_columns, block)
+    counts = np.stack([
+        (blocks == race).sum(axis=(1, 3)) for race in range(1, races + 1)
+        ])
+    majority = counts.argmax(axis=0) + 1
+    majority[counts.max(axis=0) == 0] = 0
+
+    return majority.astype(np.uint8)
+
+
+def _heatmap_grid(schelling_model, step):
+    """
+    _heatmap_grid returns the frame of a step at the level of detail
+    sent to the browser: the whole frame if it has at most
+    ``MAX_HEATMAP_SIDE`` cells on a side, otherwise blocks of cells
+    downsampled to the majority race, so the size of the payload does
+    not grow with the grid.
+
+    :return: the grid and the side of the blocks, 1 if not downsampled
+    :rtype: tuple
+    """
+    grid = _display_grid(schelling_model, step)
+    block = -(-max(grid.shape) // MAX_HEATMAP_SIDE)
+    if block > 1:
+        grid = _downsample(grid, schelling_model.races, block)
+
+    return grid, block
+
+
+def _server_figure(session_id, schelling_model, selected_step):
+    """
+    _server_figure returns the heatmap of a step rendered on the server.
+
+    The frame of a step does not change until the model is initialized
+    again, which gives it a new run id, so the figures are cached by
+    session, run and step.
+    """
+    key = (session_id, schelling_model.run_id, selected_step)
+    with CACHED_FIGURES_LOCK:
+        if key in CACHED_FIGURES:
+            CACHED_FIGURES.move_to_end(key)
+            return CACHED_FIGURES[key]
+
+    current_data, block = _heatmap_grid(schelling_model, selected_step)
+    logger.debug("current data: {} cells, blocks of {}".format(current_data.shape, block))
+    title = "Schelling's Model (Current Step: {})".format(selected_step)
+    if block > 1:
+        title += "<br>majority race of blocks of {0}x{0} houses".format(block)
     trace = go.Heatmap(
-        z=current_data,
+        # plain lists, the plotly.js of dash does not read typed arrays
+        z=current_data.tolist(),
+        # the cells are placed at the houses of the centers of the blocks
+        x0=(block - 1) / 2, dx=block,
+        y0=(block - 1) / 2, dy=block,
+        zmin=0, zmax=schelling_model.races,
         colorscale=[
             [0, "rgb(0,0,0)"],
             [0.5, "rgb(49,54,149)"],
@@ -208,16 +417,154 @@ def update_figure(selected_step, model):
             "ticktext": [0,1,2]
             }, showscale=False
     )
-    return {
+    figure = {
         "data": [trace],
         "layout": go.Layout(
             width=650, height=650,
-            title="Schelling's Model (Current Step: {})".format(selected_step),
+            title=title,
             xaxis={"title": "x"},
             yaxis={"title": "y"}
         )
     }
 
+    with CACHED_FIGURES_LOCK:
+        CACHED_FIGURES[key] = figure
+        while len(CACHED_FIGURES) > MAX_CACHED_FIGURES:
+            CACHED_FIGURES.popitem(last=False)
+
+    return figure
+
+
+@app.callback(
+    Output('graph-with-slider', 'figure'),
+    [Input('step-slider', 'value'),
+    Input('playback-mode', 'value')],
+    [State('intermediate-model-state', 'children')])
+def update_figure(selected_step, playback_mode, model):
+    logger.debug(selected_step)
+    if "browser" in (playback_mode or []):
+        # the browser renders the frames, see update_playback
+        raise PreventUpdate
+
+    # a running job must not move the agents while the frame is drawn
+    with _locked_model(model) as schelling_model:
+        logger.debug('selected step: {}'.format(selected_step))
+        selected_step = min(selected_step or 0, schelling_model.current_iteration)
+
+        return _server_figure(
+            json.loads(model).get("session"), schelling_model, selected_step
+            )
+
+
+def _playback_chunk(schelling_model, cursor):
+    """
+    _playback_chunk returns the frames the browser does not have yet.
+
+    The first frame of a run is sent whole as the base64 encoded bytes
+    of the grid, and every later step as a flat list of the index and
+    the new value of each cell that changed,
+    ``[index_1, value_1, index_2, value_2, ...]``.
+    The indices are in the row major order of the 2d list of :meth:`Schelling.frame`.
+    Large grids are downsampled the same as the heatmaps of the server,
+    see :func:`_heatmap_grid`, and ``block`` is the side of the blocks.
+
+    :param cursor: ``{"run": run_id, "last": step}`` of the frames
+        the browser has, None if it has none
+    :return: the frames of the steps after the cursor, or all of them
+        when the cursor is of another run
+    :rtype: dict
+    """
+    last = schelling_model.current_iteration
+    if (
+        cursor and cursor.get("run") == schelling_model.run_id
+        and cursor.get("last", last + 1) <= last
+    ):
+        start = cursor["last"] + 1
+    else:
+        start = 0
+
+    chunk = {
+        "run": schelling_model.run_id,
+        "races": schelling_model.races,
+        "start": start,
+        "last": last,
+        "deltas": []
+    }
+    previous = None
+    if start > 0:
+        previous = _heatmap_grid(schelling_model, start - 1)[0].ravel()
+    for step in range(start, last + 1):
+        grid, block = _heatmap_grid(schelling_model, step)
+        current = grid.ravel()
+        if previous is None:
+            chunk.update({
+                "rows": grid.shape[0],
+                "columns": grid.shape[1],
+                "block": block,
+                "base": base64.b64encode(current.tobytes()).decode("ascii")
+            })
+        else:
+            cells = np.flatnonzero(current != previous)
+            chunk["deltas"].append(
+                np.column_stack((cells, current[cells])).ravel().tolist()
+                )
+        previous = current
+
+    return chunk
+
+
+@app.callback(
+    [
+        Output('playback-chunk', 'data'),
+        Output('playback-cursor', 'data')
+    ],
+    [
+        Input('intermediate-model-state', 'children'),
+        Input('playback-mode', 'value')
+    ],
+    [State('playback-cursor', 'data')])
+def update_playback(model, playback_mode, cursor):
+    """
+    update_playback sends the new frames to the browser, which adds
+    them to the ones it has in ``playback-frames``
+    """
+    if "browser" not in (playback_mode or []):
+        raise PreventUpdate
+
+    with _locked_model(model) as schelling_model:
+        if cursor and cursor.get("run") == schelling_model.run_id \
+                and cursor.get("last") == schelling_model.current_iteration:
+            raise PreventUpdate
+
+        chunk = _playback_chunk(schelling_model, cursor)
+
+    return chunk, {"run": chunk["run"], "last": chunk["last"]}
+
+
+app.clientside_callback(
+    ClientsideFunction("playback", "merge"),
+    Output('playback-frames', 'data'),
+    [Input('playback-chunk', 'data')],
+    [State('playback-frames', 'data')]
+)
+
+app.clientside_callback(
+    ClientsideFunction("playback", "figure"),
+    Output('graph-playback', 'figure'),
+    [Input('playback-frames', 'data')]
+)
+
+app.clientside_callback(
+    ClientsideFunction("playback", "views"),
+    [
+        Output('graph-playback', 'style'),
+        Output('graph-with-slider', 'style'),
+        Output('step-slider-col', 'style')
+    ],
+    [Input('playback-mode', 'value')]
+)
+
+
 @app.callback(
     Output('intermediate-model-state-copy', 'children'),
     [
@@ -233,9 +580,10 @@ def copy_model_state(model):
     [Input('model-grid-width', 'value'),
     Input('model-grid-height', 'value'),
     Input('model-sim-threshold', 'value'),
-    Input('model-calculate', 'n_clicks')],
+    Input('model-calculate', 'n_clicks'),
+    Input('job-interval', 'n_intervals')],
     [State('intermediate-model-state-copy', 'children')])
-def update_model(width, height, sim_th, n_clicks, model):
+def update_model(width, height, sim_th, n_clicks, n_intervals, model):
     logger.debug(f"width: {width}, height: {height}")
     if width is None:
         width = PRE_DEFINED_WIDTH
@@ -246,40 +594,83 @@ def update_model(width, height, sim_th, n_clicks, model):
 
     logger.debug(f"width: {width}, height: {height}; adjusted")
 
-    existing_param = json.loads(model)
-
+    token = json.loads(model)
+    session_id = token.get("session")
     param = {
         "width": width,
         "height": height,
         "empty_house_rate": PRE_DEFINED_EMPTY_HOUSE_RATE,
         "neighbour_similarity": sim_th,
         "n_iterations": PRE_DEFINED_MAX_ITERATIONS,
-        "races": PRE_DEFINED_ETHICAL
+        "races": PRE_DEFINED_ETHICAL,
+        "history": PRE_DEFINED_HISTORY,
+        "cycle_detection": True,
+        "plateau_window": PRE_DEFINED_PLATEAU_WINDOW
     }
 
-    changed = False
-    for p in ['width', 'height', 'neighbour_similarity']:
-        if existing_param.get(p) != param.get(p):
-            changed = True
+    # two clicks must not evolve the same model at the same time
+    with _locked_model(model) as schelling_model:
+        changed = False
+        for p in ['width', 'height', 'neighbour_similarity']:
+            if getattr(schelling_model, p) != param.get(p):
+                changed = True
+
+        triggered = [t["prop_id"] for t in dash.callback_context.triggered]
+        if JOBS.running(session_id):
+            # the job owns the model until it is done or cancelled
+            logger.debug('session {} has a running job'.format(session_id))
+        elif 'job-interval.n_intervals' in triggered:
+            # the job has saved the model, only refresh the views
+            pass
+        elif changed:
+            schelling_model = Schelling(param)
+            schelling_model.initialize()
+            SESSION_STORE.set(session_id, schelling_model)
+        else:
+            logger.debug('model is: {}'.format(session_id))
+            schelling_model.evove_one()
+            SESSION_STORE.set(session_id, schelling_model)
+
+    return _session_token(session_id, token.get("version", 0) + 1)
 
-    if changed:
-        schelling_model = Schelling(param)
-        schelling_model.initialize()
-        current_iteration = schelling_model.current_iteration
-        current_data = schelling_model.data.get(current_iteration)
-        current_state = schelling_model.model_state()
+@app.callback(
+    [
+        Output('job-interval', 'disabled'),
+        Output('job-status', 'children')
+    ],
+    [
+        Input('model-run', 'n_clicks'),
+        Input('model-cancel', 'n_clicks'),
+        Input('job-interval', 'n_intervals')
+    ],
+    [State('intermediate-model-state', 'children')])
+def update_job(run_clicks, cancel_clicks, n_intervals, model):
+    session_id = json.loads(model).get("session")
+    triggered = [t["prop_id"] for t in dash.callback_context.triggered]
+
+    if 'model-run.n_clicks' in triggered and run_clicks:
+        if JOBS.running(session_id):
+            return False, "A job is already running, please wait or cancel it."
+        if JOBS.start(session_id, _load_model(model)) is None:
+            return True, "The server is busy, please try again later."
+
+    elif 'model-cancel.n_clicks' in triggered and cancel_clicks:
+        JOBS.cancel(session_id)
+
+    job = JOBS.get(session_id)
+    if job is None:
+        return True, ""
+
+    progress = job.progress()
+    status = "{}: iteration {}, changes {}, order parameter {}".format(
+        progress["status"], progress["iteration"], progress["changes"],
+        "{:.3f}".format(progress["order_parameter"])
+        if progress["order_parameter"] is not None else None
+        )
 
-        return json.dumps(current_state)
-    else:
-        logger.debug('model is: {}'.format(existing_param))
-        schelling_model = Schelling(existing_param)
-        logger.debug('reloaded model agents: {}'.format(schelling_model.agents))
-        schelling_model.evove_one()
-        current_iteration = schelling_model.current_iteration
-        current_data = schelling_model.data.get(current_iteration)
-        current_state = schelling_model.model_state()
+    # keep polling until the job is done
+    return job.done, status
 
-        return json.dumps(current_state)
 
 @app.callback(
     Output('model-calculate', 'children'),
@@ -315,71 +706,35 @@ def update_button(n):
 #     logger.debug("current data: {}".format(CURRENT_DATA))
 #     return "hidden"
 
-@app.callback(
-    Output('step-slider', 'value'),
-    [
-        Input('model-calculate', 'n_clicks'),
-        Input('intermediate-model-state', 'children')
-    ])
-def update_step_slider_value(n, model):
-    if n is None:
-        n = 0
-
-    model = json.loads(model)
-    current_iteration = model.get('current_iteration')
-
-    return current_iteration
-
-@app.callback(
-    Output('step-slider', 'max'),
-    [
-        Input('model-calculate', 'n_clicks'),
-        Input('intermediate-model-state', 'children')
-        ])
-def update_step_slider_max(n, model):
-    if n is None:
-        n = 0
-
-    model = json.loads(model)
-    current_iteration = model.get('current_iteration')
-
-    return current_iteration
-
-@app.callback(
-    Output('step-slider', 'marks'),
-    [
-        Input('model-calculate', 'n_clicks'),
-        Input('intermediate-model-state', 'children')
-        ])
-def update_step_slider_marks(n, model):
-    if n is None:
-        n = 0
-
-    model = json.loads(model)
-    current_iteration = model.get('current_iteration')
-
-    return {
-        i: '{}'.format(i) if i == 1 else str(i)
-                        for i in range(current_iteration+1)
-                        }
-
-@app.callback(
-    Output('graph-changes', 'figure'),
-    [
-        Input('model-calculate', 'n_clicks'),
-        Input('intermediate-model-state', 'children')
-        ])
-def update_graph_changes(n, model):
-    if n is None:
-        n = 0
-
-    model = json.loads(model)
-
+def _slider_marks(current_iteration):
+    """
+    _slider_marks labels at most ``MAX_SLIDER_MARKS`` steps of the slider,
+    every 1, 2, 5, 10, 20, 50, ... steps and the last step, so the marks
+    do not grow with the run. The other steps can still be picked.
+    """
+    stride, scale = 1, 1
+    while current_iteration // stride + 1 > MAX_SLIDER_MARKS - 1:
+        for multiple in (2, 5, 10):
+            stride = multiple * scale
+            if current_iteration // stride + 1 <= MAX_SLIDER_MARKS - 1:
+                break
+        scale *= 10
+
+    marks = {i: str(i) for i in range(0, current_iteration + 1, stride)}
+    # the last mark would overlap the one before
+    if current_iteration % stride and current_iteration % stride < stride / 2:
+        marks.pop(current_iteration - current_iteration % stride, None)
+    marks[current_iteration] = str(current_iteration)
+
+    return marks
+
+
+def _changes_figure(changes):
     return {
         "data": [
             go.Scatter(
-                x=[idx for idx, _ in enumerate(model.get('changes'))],
-                y=model.get('changes'),
+                x=[idx for idx, _ in enumerate(changes)],
+                y=changes,
                 mode='lines',
                 marker={'size': 10, "opacity": 0.6, "line": {'width': 0.5}},
             )
@@ -393,24 +748,12 @@ def update_graph_changes(n, model):
         }
 
 
-
-@app.callback(
-    Output('graph-order-params', 'figure'),
-    [
-        Input('model-calculate', 'n_clicks'),
-        Input('intermediate-model-state', 'children')
-        ])
-def update_graph_order_parameters(n, model):
-    if n is None:
-        n = 0
-
-    model = json.loads(model)
-
+def _order_parameters_figure(order_parameters):
     return {
         "data": [
             go.Scatter(
-                x=[idx for idx, _ in enumerate(model.get('order_parameters'))],
-                y=model.get('order_parameters'),
+                x=[idx for idx, _ in enumerate(order_parameters)],
+                y=order_parameters,
                 mode='lines',
                 marker={'size': 10, "opacity": 0.6, "line": {'width': 0.5}},
             )
@@ -424,6 +767,82 @@ def update_graph_order_parameters(n, model):
         }
 
 
+def _extend_data(values, start):
+    """
+    _extend_data is the ``extendData`` of a graph of :func:`_changes_figure`
+    or :func:`_order_parameters_figure` that adds the values after start
+    """
+    return [
+        {"x": [list(range(start, len(values)))], "y": [list(values[start:])]},
+        [0]
+        ]
+
+
+# all the widgets that depend on the model state are updated
+# in one callback so that the model is loaded once per update
+@app.callback(
+    [
+        Output('step-slider', 'value'),
+        Output('step-slider', 'max'),
+        Output('step-slider', 'marks'),
+        Output('graph-changes', 'figure'),
+        Output('graph-changes', 'extendData'),
+        Output('graph-order-params', 'figure'),
+        Output('graph-order-params', 'extendData'),
+        Output('series-cursor', 'data')
+    ],
+    [
+        Input('model-calculate', 'n_clicks'),
+        Input('intermediate-model-state', 'children')
+    ],
+    [State('series-cursor', 'data')])
+def update_model_views(n, model, cursor):
+    """
+    update_model_views updates the slider and the graphs of the changes
+    and of the order parameters.
+
+    The graphs are sent whole for a new run or page, and then only the
+    points of the new steps are added with ``extendData``, so an update
+    does not grow with the number of steps. ``series-cursor`` holds the
+    run and the number of points the browser has.
+    """
+    if n is None:
+        n = 0
+
+    # a running job must not add a step while the series are read
+    with _locked_model(model) as schelling_model:
+        current_iteration = schelling_model.current_iteration
+        changes = schelling_model.changes
+        order_parameters = schelling_model.order_parameters
+        points = len(changes)
+
+        if (
+            cursor and cursor.get("run") == schelling_model.run_id
+            and cursor.get("points", points + 1) <= points
+        ):
+            start = cursor["points"]
+            changes_figure = order_parameters_figure = dash.no_update
+            if start < points:
+                changes_data = _extend_data(changes, start)
+                order_parameters_data = _extend_data(order_parameters, start)
+            else:
+                changes_data = order_parameters_data = dash.no_update
+        else:
+            changes_figure = _changes_figure(changes)
+            order_parameters_figure = _order_parameters_figure(order_parameters)
+            changes_data = order_parameters_data = dash.no_update
+
+        return (
+            current_iteration,
+            current_iteration,
+            _slider_marks(current_iteration),
+            changes_figure,
+            changes_data,
+            order_parameters_figure,
+            order_parameters_data,
+            {"run": schelling_model.run_id, "points": points}
+        )
+
 
 if __name__ == '__main__':
     app.run_server(debug=False)
@@ -0,0 +1,144 @@
+/*
+ * Playback of the frames of a model in the browser.
+ *
+ * The server sends the frames once, see _playback_chunk in app.py:
+ * the first frame of a run as the base64 encoded bytes of the grid and
+ * every later step as the cells that changed. The frames are rebuilt
+ * here into the animation frames of the heatmap, so scrubbing the
+ * slider and playing do not call the server. Large grids arrive
+ * downsampled to blocks of houses, see _heatmap_grid in app.py.
+ */
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    playback: {
+        // adds a chunk from update_playback to the frames of the browser
+        merge: function(chunk, frames) {
+            if (!chunk) {
+                return window.dash_clientside.no_update;
+            }
+            if (chunk.start === 0 || !frames || frames.run !== chunk.run) {
+                return {
+                    run: chunk.run,
+                    races: chunk.races,
+                    rows: chunk.rows,
+                    columns: chunk.columns,
+                    block: chunk.block || 1,
+                    base: chunk.base,
+                    deltas: chunk.deltas
+                };
+            }
+            // deltas[i] holds the changes of step i+1
+            return Object.assign({}, frames, {
+                deltas: frames.deltas.slice(0, chunk.start - 1).concat(chunk.deltas)
+            });
+        },
+
+        figure: function(frames) {
+            if (!frames || !frames.base) {
+                return window.dash_clientside.no_update;
+            }
+            var bytes = window.atob(frames.base);
+            var grid = new Array(bytes.length);
+            for (var i = 0; i < bytes.length; i++) {
+                grid[i] = bytes.charCodeAt(i);
+            }
+
+            function rows() {
+                var z = [];
+                for (var r = 0; r < frames.rows; r++) {
+                    z.push(grid.slice(r * frames.columns, (r + 1) * frames.columns));
+                }
+                return z;
+            }
+
+            var animationFrames = [{name: "0", data: [{z: rows()}]}];
+            frames.deltas.forEach(function(delta, step) {
+                for (var j = 0; j < delta.length; j += 2) {
+                    grid[delta[j]] = delta[j + 1];
+                }
+                animationFrames.push({name: String(step + 1), data: [{z: rows()}]});
+            });
+            var last = animationFrames.length - 1;
+            // side of the blocks of houses of a downsampled grid
+            var block = frames.block || 1;
+
+            function animateTo(names, duration) {
+                return [names, {
+                    mode: "immediate",
+                    frame: {duration: duration, redraw: true},
+                    transition: {duration: 0}
+                }];
+            }
+
+            return {
+                data: [{
+                    type: "heatmap",
+                    z: animationFrames[last].data[0].z,
+                    x0: (block - 1) / 2,
+                    dx: block,
+                    y0: (block - 1) / 2,
+                    dy: block,
+                    zmin: 0,
+                    zmax: frames.races,
+                    colorscale: [
+                        [0, "rgb(0,0,0)"],
+                        [0.5, "rgb(49,54,149)"],
+                        [1, "rgb(244,109,67)"]
+                    ],
+                    showscale: false
+                }],
+                layout: {
+                    width: 650,
+                    height: 650,
+                    title: "Schelling's Model",
+                    xaxis: {title: "x"},
+                    yaxis: {title: "y"},
+                    updatemenus: [{
+                        type: "buttons",
+                        direction: "left",
+                        showactive: false,
+                        x: 0,
+                        y: 0,
+                        xanchor: "right",
+                        yanchor: "top",
+                        pad: {t: 60, r: 10},
+                        buttons: [
+                            {
+                                label: "Play",
+                                method: "animate",
+                                args: [null, Object.assign(
+                                    animateTo(null, 300)[1], {fromcurrent: true}
+                                )]
+                            },
+                            {
+                                label: "Pause",
+                                method: "animate",
+                                args: animateTo([null], 0)
+                            }
+                        ]
+                    }],
+                    sliders: [{
+                        active: last,
+                        pad: {t: 50},
+                        currentvalue: {prefix: "Current Step: "},
+                        steps: animationFrames.map(function(frame) {
+                            return {
+                                label: frame.name,
+                                method: "animate",
+                                args: animateTo([frame.name], 0)
+                            };
+                        })
+                    }]
+                },
+                frames: animationFrames
+            };
+        },
+
+        // shows the browser playback or the views rendered by the server
+        views: function(playbackMode) {
+            var browser = (playbackMode || []).indexOf("browser") >= 0;
+            var shown = {};
+            var hidden = {display: "none"};
+            return browser ? [shown, hidden, hidden] : [hidden, shown, shown];
+        }
+    }
+});
@@ -36,6 +36,10 @@ alert = dbc.Alert(
             "Type in your desired parameters and press the button to initialize and calculate. Each click of the button only calculates one step of the model. (I made it this way because I am running this on a potato server.) ",
             className="mb-0",
         ),
+        html.P(
+            "Run to Equilibrium keeps calculating in the background until nobody moves, the same grid comes back or nothing changes on average any more, and Cancel stops it.",
+            className="mb-0",
+        ),
         html.P(
             "The calculation history can be reviewed by clicking on the slider at the bottom of the page.",
             className="mb-0",
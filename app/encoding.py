@@ -0,0 +1,40 @@
+import base64
+import zlib
+
+import numpy as np
+
+
+def encode_array(array, dtype):
+    """
+    encode_array packs an array into a short ascii string:
+    the raw little endian bytes, compressed with zlib and base64 encoded.
+    The fastest compression level is used, the arrays are mostly small
+    integers which compress well anyway.
+
+    :param array: array or list of numbers
+    :param dtype: numpy dtype to store the numbers with, such as uint8
+    :return: encoded array
+    :rtype: str
+    """
+    raw = np.ascontiguousarray(array, dtype=np.dtype(dtype).newbyteorder("<")).tobytes()
+
+    return base64.b64encode(zlib.compress(raw, 1)).decode("ascii")
+
+
+def decode_array(text, dtype, shape = None):
+    """
+    decode_array reverses :func:`encode_array`
+
+    :param text: encoded array
+    :type text: str
+    :param dtype: numpy dtype used by encode_array
+    :param shape: shape of the array, flat if None
+    :rtype: numpy.ndarray
+    """
+    raw = zlib.decompress(base64.b64decode(text))
+    array = np.frombuffer(raw, dtype=np.dtype(dtype).newbyteorder("<"))
+    array = array.astype(dtype)
+    if shape is not None:
+        array = array.reshape(shape)
+
+    return array
@@ -0,0 +1,250 @@
+"""
+Ensembles of replicas of the Schelling model.
+
+An :class:`Ensemble` evolves many replicas of the same configuration at
+once, as one array of shape (replicas, width, height), so the statistics
+of the order parameter over hundreds of replicas cost a few array
+operations per step instead of hundreds of models::
+
+    ensemble = Ensemble({"width": 50, "height": 50, "n_iterations": 200}, replicas=500, seed=0)
+    ensemble.initialize()
+    ensemble.evolve()
+    ensemble.order_parameters.mean(axis=0)
+"""
+import logging
+
+import numpy as np
+
+from models import Neighbourhood
+
+logging.basicConfig()
+logger = logging.getLogger('ensemble')
+logger.setLevel(logging.WARNING)
+
+
+class Ensemble():
+    """
+    Ensemble evolves replicas of a Schelling model together.
+
+    The replicas follow the synchronous update of :class:`models.Schelling`,
+    see ``Schelling._evolve_one_synchronous``: all the agents are
+    evaluated on the grid at the start of the step, every unsatisfied
+    agent picks a random empty house of its replica, and when several
+    agents pick the same house only the one with the highest random
+    priority moves. This is what makes the replicas vectorizable, the
+    sequential update moves the agents one after the other.
+
+    Each replica has its own random number generator, spawned from the
+    seed of the ensemble, so a replica does not depend on the number of
+    replicas or on the other replicas. The runs are not the same as the
+    ones of ``Schelling`` with the same seed.
+
+    A replica is in equilibrium after a step where no agent moved. It
+    does not change any more, so it is left out of the later steps.
+
+    :param model: configuration of the replicas, the same keys as for
+        :class:`models.Schelling`: ``width``, ``height``, ``races``,
+        ``empty_house_rate``, ``neighbour_similarity``, ``n_iterations``,
+        ``neighbourhood``, ``radius`` and ``torus``
+    :type model: dict
+    :param replicas: number of replicas
+    :type replicas: int
+    :param seed: seed of the ensemble
+    :type seed: int
+    """
+    def __init__(self, model = None, replicas = None, seed = None):
+
+        if model is None:
+            model = {}
+
+        self.width = model.get("width") or 20
+        self.height = model.get("height") or 20
+        self.races = model.get("races") or 2
+        if model.get("empty_house_rate") is None:
+            self.empty_house_rate = 0.2
+        else:
+            self.empty_house_rate = model.get("empty_house_rate")
+        self.neighbour_similarity = model.get("neighbour_similarity") or 0.6
+        self.n_iterations = model.get("n_iterations") or 100
+        self.neighbourhood = Neighbourhood(
+            self.width, self.height, model.get("neighbourhood"), model.get("radius"),
+            model.get("torus") or False
+            )
+        self.replicas = replicas or 1
+        self.seed = seed
+        self.rngs = [
+            np.random.default_rng(sequence)
+            for sequence in np.random.SeedSequence(seed).spawn(self.replicas)
+            ]
+
+        self.current_iteration = 0
+        self.lattices = None
+        # True for the replicas in equilibrium
+        self.equilibrium = np.zeros(self.replicas, dtype=np.bool_)
+        # iteration each replica reached equilibrium at, -1 if it has not
+        self.equilibrium_iterations = np.full(self.replicas, -1, dtype=np.int64)
+        self._changes = []
+        self._order_parameters = []
+
+    @property
+    def changes(self):
+        """
+        number of agents moved in each replica at each step
+
+        :return: array of shape (replicas, steps)
+        :rtype: numpy.ndarray
+        """
+        return np.array(self._changes, dtype=np.int64).reshape(-1, self.replicas).T
+
+    @property
+    def order_parameters(self):
+        """
+        average fraction of similar neighbours of the agents of each
+        replica after each step
+
+        :return: array of shape (replicas, steps)
+        :rtype: numpy.ndarray
+        """
+        return np.array(self._order_parameters).reshape(-1, self.replicas).T
+
+    def initialize(self):
+        """
+        initialize places the empty houses and the agents of every replica
+        at random, the races in consecutive chunks of the shuffled houses
+        like :meth:`models.Schelling.initialize`
+        """
+        n_houses = self.width * self.height
+        n_empty = int(self.empty_house_rate * n_houses)
+        k, m = divmod(n_houses - n_empty, self.races)
+        races = np.repeat(
+            np.arange(1, self.races + 1, dtype=np.int8),
+            [k + (i < m) for i in range(self.races)]
+            )
+        houses = np.stack([rng.permutation(n_houses) for rng in self.rngs])
+
+        lattices = np.zeros((self.replicas, n_houses), dtype=np.int8)
+        np.put_along_axis(lattices, houses[:, n_empty:], races, axis=1)
+        self.lattices = lattices.reshape(self.replicas, self.width, self.height)
+        self.n_agents = n_houses - n_empty
+
+        self.current_iteration = 0
+        self.equilibrium[:] = False
+        self.equilibrium_iterations[:] = -1
+        self._changes = []
+        self._order_parameters = []
+        self._count_neighbours()
+
+    def _count_neighbours(self):
+        """
+        _count_neighbours computes the neighbour counts of all the replicas
+        """
+        self._occupied_counts, self._similar_counts = self.neighbourhood.counts(
+            self.lattices
+            )
+
+    def _order_parameter(self, lattices, occupied_counts, similar_counts):
+        """
+        _order_parameter is the average fraction of similar neighbours of
+        the agents of each replica, 0 for agents without neighbours
+
+        :rtype: numpy.ndarray
+        """
+        similarity = similar_counts / np.maximum(occupied_counts, 1)
+        similarity[lattices == 0] = 0.0
+
+        return similarity.sum(axis=(1, 2)) / max(self.n_agents, 1)
+
+    def evolve_one(self):
+        """
+        evolve_one moves the unsatisfied agents of the replicas that are not
+        in equilibrium
+
+        :return: number of agents moved in each replica
+        :rtype: numpy.ndarray
+        """
+        self.current_iteration += 1
+        n_houses = self.width * self.height
+        # only the replicas that are not in equilibrium are evolved
+        replicas = np.flatnonzero(~self.equilibrium)
+        lattices = self.lattices[replicas]
+        occupied_counts = self._occupied_counts[replicas]
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            similarity = self._similar_counts[replicas] / occupied_counts
+        unsatisfied = (
+            (lattices > 0) & (occupied_counts > 0)
+            & (similarity < self.neighbour_similarity)
+        )
+
+        # flat indices replica * n_houses + x * height + y in the evolved
+        # replicas, sorted by replica
+        flat = lattices.reshape(-1)
+        movers = np.flatnonzero(unsatisfied)
+        vacancies = np.flatnonzero(flat == 0)
+        n_vacancies = np.bincount(vacancies // n_houses, minlength=len(replicas))
+        movers = movers[n_vacancies[movers // n_houses] > 0]
+        mover_replicas = movers // n_houses
+        n_movers = np.bincount(mover_replicas, minlength=len(replicas))
+
+        # a random number for the house and one for the priority of each
+        # agent, from the generator of its replica
+        draws = np.concatenate(
+            [np.empty((0, 2))] + [
+                self.rngs[replica].random((n, 2))
+                for replica, n in zip(replicas.tolist(), n_movers.tolist()) if n
+            ])
+        first_vacancy = np.cumsum(n_vacancies) - n_vacancies
+        targets = vacancies[
+            first_vacancy[mover_replicas]
+            + (draws[:, 0] * n_vacancies[mover_replicas]).astype(np.int64)
+            ]
+        # the agent with the highest priority of each house moves
+        order = np.lexsort((-draws[:, 1], targets))
+        first = np.ones(len(order), dtype=np.bool_)
+        first[1:] = targets[order][1:] != targets[order][:-1]
+        winners = order[first]
+        origins, houses = movers[winners], targets[winners]
+
+        flat[houses] = flat[origins]
+        flat[origins] = 0
+        occupied_counts, similar_counts = self.neighbourhood.counts(lattices)
+        self.lattices[replicas] = lattices
+        self._occupied_counts[replicas] = occupied_counts
+        self._similar_counts[replicas] = similar_counts
+
+        changes = np.zeros(self.replicas, dtype=np.int64)
+        changes[replicas] = np.bincount(origins // n_houses, minlength=len(replicas))
+        if self._order_parameters:
+            order_parameters = self._order_parameters[-1].copy()
+        else:
+            order_parameters = self._order_parameter(
+                self.lattices, self._occupied_counts, self._similar_counts
+                )
+        order_parameters[replicas] = self._order_parameter(
+            lattices, occupied_counts, similar_counts
+            )
+
+        in_equilibrium = changes == 0
+        in_equilibrium[self.equilibrium] = False
+        self.equilibrium |= in_equilibrium
+        self.equilibrium_iterations[in_equilibrium] = self.current_iteration
+        self._changes.append(changes)
+        self._order_parameters.append(order_parameters)
+        logger.debug("iteration {}: {} replicas in equilibrium".format(
+            self.current_iteration, int(self.equilibrium.sum())
+            ))
+
+        return changes
+
+    def evolve(self, n_steps = None):
+        """
+        evolve evolves the replicas until they are all in equilibrium or
+        n_steps are done
+
+        :param n_steps: maximum number of steps, n_iterations if None
+        :type n_steps: int
+        """
+        for _ in range(n_steps or self.n_iterations):
+            self.evolve_one()
+            if self.equilibrium.all():
+                break
@@ -0,0 +1,397 @@
+import collections
+import itertools
+import json
+import logging
+import os
+
+import numpy as np
+
+from encoding import decode_array, encode_array
+
+logging.basicConfig()
+logger = logging.getLogger('history')
+logger.setLevel(logging.WARNING)
+
+
+class DeltaHistory():
+    """
+    DeltaHistory records the trajectory of a model as the moves of each step
+    plus a full keyframe of the grid every few steps.
+
+    A frame is rebuilt by taking the nearest keyframe or recently built frame
+    and replaying (or undoing) the moves in between. The recently built
+    frames are kept in a small LRU cache, so moving the slider step by step
+    only replays one step.
+
+    The frames are arrays of races with shape (width, height) and 0 for
+    empty houses. They are shared with the cache and should not be changed.
+
+    :param width: width of the grid
+    :param height: height of the grid
+    :param keyframe_interval: number of steps between two keyframes
+    :param cache_size: number of frames kept in the LRU cache
+    """
+    def __init__(self, width, height, keyframe_interval = None, cache_size = None):
+
+        self.width = width
+        self.height = height
+        self.keyframe_interval = keyframe_interval or 10
+        self.cache_size = cache_size or 32
+        # keyframes can be nested lists when reloaded, see _keyframe
+        self.keyframes = {}
+        # moves[i] holds the moves of step i+1 as rows of
+        # (x_from, y_from, x_to, y_to, race)
+        self.moves = []
+        self._cache = collections.OrderedDict()
+
+    @property
+    def last_step(self):
+        return len(self.moves)
+
+    def start(self, lattice):
+        """
+        start clears the history and saves the grid of step 0
+
+        :param lattice: array of races with shape (width, height)
+        :type lattice: numpy.ndarray
+        """
+        self.keyframes = {0: np.array(lattice, dtype=np.int8)}
+        self.moves = []
+        self._cache.clear()
+
+    def append(self, moves, lattice):
+        """
+        append records the moves of the next step
+
+        :param moves: list of moves (from, to, race)
+            such as [((0, 1), (3, 4), 2)]
+        :type moves: list
+        :param lattice: grid after the moves, only copied for keyframes
+        :type lattice: numpy.ndarray
+        """
+        self.moves.append(
+            np.array(
+                [(*house_from, *house_to, race) for house_from, house_to, race in moves],
+                dtype=np.int32
+                ).reshape(-1, 5)
+            )
+        if self.last_step % self.keyframe_interval == 0:
+            self.keyframes[self.last_step] = np.array(lattice, dtype=np.int8)
+
+    def _keyframe(self, step):
+        keyframe = self.keyframes[step]
+        if not isinstance(keyframe, np.ndarray):
+            keyframe = np.array(keyframe, dtype=np.int8)
+            self.keyframes[step] = keyframe
+        return keyframe
+
+    def frame(self, step):
+        """
+        frame rebuilds the grid of the step
+
+        :param step: iteration, between 0 and last_step
+        :type step: int
+        :return: array of races with shape (width, height)
+        :rtype: numpy.ndarray
+        """
+        if not 0 <= step <= self.last_step:
+            raise IndexError("step {} is not recorded".format(step))
+        if step in self._cache:
+            self._cache.move_to_end(step)
+            return self._cache[step]
+
+        base = min(
+            itertools.chain(self._cache, self.keyframes),
+            key=lambda s: (abs(s - step), s)
+            )
+        if base in self._cache:
+            lattice = self._cache[base].copy()
+        else:
+            lattice = self._keyframe(base).copy()
+
+        logger.debug("frame {} from {}".format(step, base))
+        for s in range(base + 1, step + 1):
+            moves = self.moves[s - 1]
+            lattice[moves[:, 0], moves[:, 1]] = 0
+            lattice[moves[:, 2], moves[:, 3]] = moves[:, 4]
+        for s in range(base, step, -1):
+            moves = self.moves[s - 1]
+            lattice[moves[:, 2], moves[:, 3]] = 0
+            lattice[moves[:, 0], moves[:, 1]] = moves[:, 4]
+
+        lattice.flags.writeable = False
+        self._cache[step] = lattice
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+        return lattice
+
+    def state(self, compact = False):
+        """
+        state returns the history as json serializable dict
+
+        :param compact: encode the keyframes and the moves with
+            :func:`encoding.encode_array` instead of lists
+        :type compact: bool
+        """
+        if compact:
+            moves = np.concatenate(self.moves) if self.moves else np.zeros((0, 5))
+            return {
+                "format": "compact",
+                "width": self.width,
+                "height": self.height,
+                "keyframe_interval": self.keyframe_interval,
+                "keyframes": {
+                    step: encode_array(keyframe, np.uint8)
+                    for step, keyframe in self.keyframes.items()
+                    },
+                # moves of all the steps as flat indices x * height + y,
+                # split by the number of moves per step
+                "moves_from": encode_array(moves[:, 0] * self.height + moves[:, 1], np.uint32),
+                "moves_to": encode_array(moves[:, 2] * self.height + moves[:, 3], np.uint32),
+                "moves_race": encode_array(moves[:, 4], np.uint8),
+                "n_moves": encode_array([len(m) for m in self.moves], np.uint32)
+            }
+
+        return {
+            "width": self.width,
+            "height": self.height,
+            "keyframe_interval": self.keyframe_interval,
+            "keyframes": {
+                step: np.asarray(keyframe).tolist()
+                for step, keyframe in self.keyframes.items()
+                },
+            "moves": [m.tolist() for m in self.moves]
+        }
+
+    @classmethod
+    def from_state(cls, state, cache_size = None):
+        """
+        from_state loads the history saved by :meth:`state`
+
+        The keyframes are only converted to arrays when they are used.
+        """
+        history = cls(
+            state.get("width"), state.get("height"),
+            state.get("keyframe_interval"), cache_size
+            )
+        if state.get("format") == "compact":
+            shape = (history.width, history.height)
+            history.keyframes = {
+                int(step): decode_array(keyframe, np.uint8, shape).astype(np.int8)
+                for step, keyframe in state.get("keyframes").items()
+                }
+            moves_from = decode_array(state.get("moves_from"), np.uint32).astype(np.int32)
+            moves_to = decode_array(state.get("moves_to"), np.uint32).astype(np.int32)
+            moves = np.stack([
+                moves_from // history.height, moves_from % history.height,
+                moves_to // history.height, moves_to % history.height,
+                decode_array(state.get("moves_race"), np.uint8).astype(np.int32)
+            ], axis=1)
+            n_moves = decode_array(state.get("n_moves"), np.uint32)
+            history.moves = np.split(
+                moves, np.cumsum(n_moves)[:-1]
+                ) if len(n_moves) else []
+            return history
+
+        history.keyframes = {
+            int(step): keyframe for step, keyframe in state.get("keyframes").items()
+            }
+        history.moves = [
+            np.array(m, dtype=np.int32).reshape(-1, 5) for m in state.get("moves")
+            ]
+        return history
+
+
+
+class TrajectoryFile():
+    """
+    TrajectoryFile stores the grid of every step in a memory mapped file,
+    one byte per house, so that long runs on large grids do not have to
+    keep their history in memory.
+
+    The frames are written one after the other in ``path``, which grows by
+    doubling its capacity. The values of each frame such as ``changes``
+    are appended as a json line to ``path + ".series"``, so writing a frame
+    does not cost more as the run grows. The dimensions, the number of
+    frames and the other metadata are kept in the small json sidecar
+    ``path + ".json"``, which is replaced after each frame is written so a
+    reader never sees a frame that is not complete.
+
+    Readers open the file with ``mode="r"`` and :meth:`frame` returns a view
+    of the file, so only the pages of the requested step are read.
+
+    :param path: path of the file of frames
+    :param width: width of the grid, read from the sidecar if None
+    :param height: height of the grid, read from the sidecar if None
+    :param mode: ``"w"`` creates the file, ``"a"`` appends to an existing
+        file and ``"r"`` only reads it
+    :param capacity: number of frames the new file has room for
+    """
+    format_version = 2
+
+    def __init__(self, path, width = None, height = None, mode = None, capacity = None):
+
+        self.path = path
+        self.mode = mode or "r"
+        if self.mode not in ("w", "a", "r"):
+            raise Exception("No mode {} found".format(self.mode))
+        self._frames = None
+        self._series = None
+
+        if self.mode == "w":
+            self.width = width
+            self.height = height
+            self.n_frames = 0
+            self.metadata = {}
+            with open(self.path, "wb") as f:
+                f.truncate(self._frame_bytes * (capacity or 16))
+            with open(self.series_path, "w"):
+                pass
+        else:
+            if not os.path.exists(self.sidecar_path):
+                raise Exception("No trajectory {} found".format(self.path))
+            self._read_sidecar()
+
+        self._map()
+
+    @property
+    def sidecar_path(self):
+        return self.path + ".json"
+
+    @property
+    def series_path(self):
+        return self.path + ".series"
+
+    @property
+    def _frame_bytes(self):
+        return self.width * self.height
+
+    @property
+    def capacity(self):
+        return os.path.getsize(self.path) // max(self._frame_bytes, 1)
+
+    def _read_sidecar(self):
+        with open(self.sidecar_path) as f:
+            sidecar = json.load(f)
+        self.width = sidecar.pop("width")
+        self.height = sidecar.pop("height")
+        self.n_frames = sidecar.pop("n_frames")
+        sidecar.pop("format_version", None)
+        sidecar.pop("dtype", None)
+        self.metadata = sidecar
+
+    def _map(self):
+        """_map maps the file, writers map the whole capacity"""
+        n_frames = self.n_frames if self.mode == "r" else self.capacity
+        if n_frames == 0:
+            self._frames = np.zeros((0, self.width, self.height), dtype=np.uint8)
+            return
+        self._frames = np.memmap(
+            self.path, dtype=np.uint8, mode="r" if self.mode == "r" else "r+",
+            shape=(n_frames, self.width, self.height)
+            )
+
+    def append(self, lattice, **values):
+        """
+        append writes the grid of the next step
+
+        :param lattice: array of races with shape (width, height)
+        :type lattice: numpy.ndarray
+        :param values: values of the step, see :meth:`series`
+        """
+        if self.mode == "r":
+            raise Exception("The trajectory {} is read only".format(self.path))
+        if self.n_frames == len(self._frames):
+            self._frames.flush()
+            self._frames = None
+            with open(self.path, "r+b") as f:
+                f.truncate(self._frame_bytes * max(2 * self.n_frames, 1))
+            self._map()
+        self._frames[self.n_frames] = lattice
+        if self._series is None:
+            self._series = open(self.series_path, "a")
+        self._series.write(json.dumps(values) + "\n")
+        self._series.flush()
+        self.n_frames += 1
+
+    def truncate(self, n_frames):
+        """truncate drops the frames after the first n_frames"""
+        self.n_frames = min(self.n_frames, n_frames)
+        if self.mode != "r" and os.path.exists(self.series_path):
+            if self._series is not None:
+                self._series.close()
+                self._series = None
+            with open(self.series_path) as f:
+                lines = list(itertools.islice(f, self.n_frames))
+            with open(self.series_path, "w") as f:
+                f.writelines(lines)
+
+    def series(self, name):
+        """
+        series returns a value of the frames written so far, in the order of
+        the frames that have it
+
+        :param name: name of the value given to :meth:`append`
+        :type name: str
+        :rtype: list
+        """
+        if not os.path.exists(self.series_path):
+            # the files of format_version 1 keep the series in the sidecar
+            return self.metadata.get(name, [])
+        with open(self.series_path) as f:
+            lines = itertools.islice(f, self.n_frames)
+            values = [json.loads(line) for line in lines]
+
+        return [v[name] for v in values if name in v]
+
+    def write_metadata(self, **metadata):
+        """
+        write_metadata updates the metadata and replaces the sidecar,
+        the frames written so far become visible to the readers. The
+        metadata should be small, it is written again with every frame.
+        """
+        self.metadata.update(metadata)
+        sidecar = {
+            "format_version": self.format_version,
+            "width": self.width,
+            "height": self.height,
+            "dtype": "uint8",
+            "n_frames": self.n_frames
+        }
+        sidecar.update(self.metadata)
+        tmp_path = self.sidecar_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(sidecar, f)
+        os.replace(tmp_path, self.sidecar_path)
+
+    def frame(self, step):
+        """
+        frame returns the grid of a step as a read only view of the file
+
+        :param step: iteration
+        :type step: int
+        :rtype: numpy.ndarray
+        """
+        if self.mode == "r" and step >= self.n_frames:
+            # the writer may have added frames since the file was opened
+            self._read_sidecar()
+            self._map()
+        if not 0 <= step < self.n_frames:
+            raise IndexError("No step {} in {}".format(step, self.path))
+        frame = self._frames[step]
+        frame.flags.writeable = False
+
+        return frame
+
+    def flush(self):
+        """flush writes the frames in memory to the disk"""
+        if self._frames is not None and self.mode != "r":
+            self._frames.flush()
+
+    def close(self):
+        self.flush()
+        self._frames = None
+        if self._series is not None:
+            self._series.close()
+            self._series = None
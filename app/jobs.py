@@ -0,0 +1,209 @@
+import concurrent.futures
+import logging
+import threading
+import time
+
+from store import SessionLocks
+
+logging.basicConfig()
+logger = logging.getLogger('jobs')
+logger.setLevel(logging.WARNING)
+
+
+class Job():
+    """
+    Job evolves the model of a session in the background until it reaches
+    equilibrium, a cycle or a plateau (see ``Schelling.iter_evolve``),
+    ``n_steps`` steps are done or it is cancelled.
+
+    The lock of the session is held during each step and each save, so
+    the requests that hold it never see a step half done.
+
+    :param session_id: id of the session
+    :param model: the model to evolve
+    :param n_steps: maximum number of steps
+    :param lock: lock of the session
+    """
+    def __init__(self, session_id, model, n_steps, lock = None):
+
+        self.session_id = session_id
+        self.model = model
+        self.n_steps = n_steps
+        self.lock = lock or threading.RLock()
+        self.status = "queued"
+        self.error = None
+        self.started = None
+        self.finished = None
+        self.future = None
+        self._cancelled = threading.Event()
+
+    def cancel(self):
+        self._cancelled.set()
+        if self.future is not None and self.future.cancel():
+            # run is never called for a job cancelled in the queue
+            self.finished = time.time()
+            self.status = "cancelled"
+
+    @property
+    def done(self):
+        return self.status in (
+            "equilibrium", "cycle", "plateau", "finished", "cancelled", "failed"
+            )
+
+    def progress(self):
+        """progress returns the status and the latest results of the job"""
+        with self.lock:
+            return {
+                "status": self.status,
+                "iteration": self.model.current_iteration,
+                "changes": self.model.changes[-1] if self.model.changes else None,
+                "order_parameter": (
+                    self.model.order_parameters[-1] if self.model.order_parameters else None
+                    ),
+                "error": self.error
+            }
+
+    def run(self, store, save_interval):
+        """
+        run evolves the model one step at a time, checking for cancellation
+        between steps and saving the model to the store at most every
+        ``save_interval`` seconds so that other workers see the progress.
+        """
+        self.status = "running"
+        self.started = time.time()
+        last_saved = self.started
+        status = "finished"
+        steps = self.model.iter_evolve(self.n_steps)
+        try:
+            while True:
+                with self.lock:
+                    step = next(steps, None)
+                if step is None:
+                    break
+                if step.get("stop_reason") in ("equilibrium", "cycle", "plateau"):
+                    status = step["stop_reason"]
+                    break
+                if self._cancelled.is_set():
+                    status = "cancelled"
+                    break
+                if time.time() - last_saved > save_interval:
+                    with self.lock:
+                        store.set(self.session_id, self.model)
+                    last_saved = time.time()
+            # save before the job is reported done
+            with self.lock:
+                steps.close()
+                store.set(self.session_id, self.model)
+        except Exception as e:
+            logger.exception("job of session {} failed".format(self.session_id))
+            status = "failed"
+            self.error = str(e)
+        finally:
+            self.finished = time.time()
+            self.status = status
+
+
+class JobManager():
+    """
+    JobManager runs the jobs on a bounded thread pool.
+
+    Each session can only have ``max_jobs_per_session`` jobs running or
+    queued, and no more than ``max_jobs`` jobs are accepted in total so that
+    a few users can not saturate the workers.
+
+    Jobs run in the process that started them. Their progress is saved to
+    the session store, but they can only be cancelled from that process.
+
+    :param store: session store where the models are saved
+    :param max_workers: number of threads running jobs
+    :param max_jobs: maximum number of running and queued jobs
+    :param max_jobs_per_session: maximum number of jobs of one session
+    :param save_interval: seconds between two saves of a running job
+    :param keep_finished: seconds to keep the jobs that are done
+    :param locks: locks of the sessions, shared with the requests that
+        read the models
+    :type locks: store.SessionLocks
+    """
+    def __init__(
+        self, store, max_workers = None, max_jobs = None,
+        max_jobs_per_session = None, save_interval = None, keep_finished = None,
+        locks = None
+    ):
+
+        self.store = store
+        self.locks = locks or SessionLocks()
+        self.max_workers = max_workers or 2
+        self.max_jobs = max_jobs or 2 * self.max_workers
+        self.max_jobs_per_session = max_jobs_per_session or 1
+        self.save_interval = save_interval or 1.0
+        self.keep_finished = keep_finished or 600
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.max_workers, thread_name_prefix="schelling-job"
+            )
+        # session id: list of jobs, the latest last
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def _active(self, session_id = None):
+        if session_id is None:
+            jobs = [j for session_jobs in self._jobs.values() for j in session_jobs]
+        else:
+            jobs = self._jobs.get(session_id, [])
+        return [j for j in jobs if not j.done]
+
+    def _prune(self):
+        now = time.time()
+        for session_id, jobs in list(self._jobs.items()):
+            if all(
+                j.done and now - (j.finished or now) > self.keep_finished for j in jobs
+            ):
+                del self._jobs[session_id]
+
+    def start(self, session_id, model, n_steps = None):
+        """
+        start runs a job for the model of the session
+
+        :param session_id: id of the session
+        :type session_id: str
+        :param model: the model to evolve
+        :type model: Schelling
+        :param n_steps: maximum number of steps, n_iterations of the model
+            if None
+        :type n_steps: int
+        :return: the job, or None if the limits are reached
+        :rtype: Job
+        """
+        with self._lock:
+            self._prune()
+            if len(self._active(session_id)) >= self.max_jobs_per_session:
+                logger.warning("session {} already has a job".format(session_id))
+                return None
+            if len(self._active()) >= self.max_jobs:
+                logger.warning("too many jobs, rejecting session {}".format(session_id))
+                return None
+
+            job = Job(
+                session_id, model, n_steps or model.n_iterations, self.locks(session_id)
+                )
+            # only the latest finished job of a session is kept
+            self._jobs[session_id] = self._active(session_id) + [job]
+            job.future = self._executor.submit(job.run, self.store, self.save_interval)
+
+        return job
+
+    def get(self, session_id):
+        """get returns the latest job of the session, or None"""
+        with self._lock:
+            jobs = self._jobs.get(session_id)
+            return jobs[-1] if jobs else None
+
+    def running(self, session_id):
+        """running tells if the session has a job that is not done"""
+        with self._lock:
+            return bool(self._active(session_id))
+
+    def cancel(self, session_id):
+        """cancel cancels the jobs of the session"""
+        with self._lock:
+            for job in self._active(session_id):
+                job.cancel()
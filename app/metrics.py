@@ -0,0 +1,363 @@
+"""
+Segregation metrics of the grids of the Schelling model.
+
+:func:`measure` computes all the metrics of a grid in one pass over the
+pairs of neighbouring houses: the clusters of agents of the same race,
+the length of the interface between the races, and the dissimilarity
+and exposure indices over square blocks of houses. :class:`Metrics`
+measures the grids of a model on demand or while it runs::
+
+    metrics = Metrics(schelling_model, every=5, incremental=True)
+    for step in metrics.follow(schelling_model.iter_evolve(moves=True)):
+        print(step["iteration"], step["interface_length"])
+    iterations, largest = metrics.series("largest_cluster")
+"""
+import logging
+
+import numpy as np
+
+from models import Neighbourhood
+
+logging.basicConfig()
+logger = logging.getLogger('metrics')
+logger.setLevel(logging.WARNING)
+
+# names of the metrics of measure that are numbers
+SCALAR_METRICS = (
+    "agents", "clusters", "largest_cluster", "mean_cluster_size",
+    "interface_length", "dissimilarity"
+)
+
+
+def _neighbourhood(width, height, connectivity, torus):
+    """
+    _neighbourhood is the neighbourhood of the houses that touch: the 4
+    nearest houses or the 8 houses around
+    """
+    if connectivity not in (4, 8):
+        raise Exception("No connectivity {} found".format(connectivity))
+
+    return Neighbourhood(
+        width, height, "von_neumann" if connectivity == 4 else "moore", 1, torus
+        )
+
+
+def _pairs(neighbourhood):
+    """
+    _pairs lists every pair of neighbouring houses once, as two arrays
+    of flat indices ``x * height + y``
+    """
+    width, height = neighbourhood.width, neighbourhood.height
+    houses = np.arange(width * height).reshape(width, height)
+    first, second = [], []
+    for dx, dy in neighbourhood.offsets:
+        # the other half of the offsets gives the same pairs
+        if dx < 0 or (dx == 0 and dy < 0):
+            continue
+        if neighbourhood.torus:
+            first.append(houses.ravel())
+            second.append(np.roll(houses, (-dx, -dy), axis=(0, 1)).ravel())
+        else:
+            first.append(houses[
+                max(-dx, 0):width - max(dx, 0), max(-dy, 0):height - max(dy, 0)
+                ].ravel())
+            second.append(houses[
+                max(dx, 0):width + min(dx, 0), max(dy, 0):height + min(dy, 0)
+                ].ravel())
+
+    return np.concatenate(first), np.concatenate(second)
+
+
+def connected_components(n, first, second):
+    """
+    connected_components labels the connected components of a graph with
+    a vectorized union-find.
+
+    In every round the root of each edge whose ends are in different
+    trees is linked to the smaller root, then the paths are compressed
+    by pointer jumping until every node points to its root. The labels
+    only decrease, so there are no cycles, and the number of rounds
+    grows like the logarithm of the size of the components.
+
+    :param n: number of nodes
+    :param first: first nodes of the edges
+    :type first: numpy.ndarray
+    :param second: second nodes of the edges
+    :type second: numpy.ndarray
+    :return: label of each node, the smallest node of its component
+    :rtype: numpy.ndarray
+    """
+    parent = np.arange(n)
+    while len(first):
+        roots_first, roots_second = parent[first], parent[second]
+        linked = roots_first != roots_second
+        if not linked.any():
+            break
+        first, second = first[linked], second[linked]
+        roots_first, roots_second = roots_first[linked], roots_second[linked]
+        np.minimum.at(
+            parent, np.maximum(roots_first, roots_second),
+            np.minimum(roots_first, roots_second)
+            )
+        while True:
+            grandparent = parent[parent]
+            if (grandparent == parent).all():
+                break
+            parent = grandparent
+
+    return parent
+
+
+def _block_counts(lattice, races, block_size):
+    """
+    _block_counts counts the agents of each race in square blocks of the
+    grid, the blocks on the edges may be smaller
+
+    :return: array of shape (races, blocks)
+    :rtype: numpy.ndarray
+    """
+    width, height = lattice.shape
+    blocks_x, blocks_y = -(-width // block_size), -(-height // block_size)
+    padded = np.zeros((blocks_x * block_size, blocks_y * block_size), dtype=lattice.dtype)
+    padded[:width, :height] = lattice
+
+    return np.stack([
+        (padded == race).reshape(blocks_x, block_size, blocks_y, block_size)
+        .sum(axis=(1, 3)).ravel()
+        for race in range(1, races + 1)
+        ])
+
+
+def measure(lattice, races = None, block_size = None, connectivity = None, torus = False):
+    """
+    measure computes the segregation metrics of a grid:
+
+    - ``agents``: number of agents,
+    - ``cluster_sizes``: sizes of the clusters of each race, largest
+      first, as a dict of race: list. A cluster is a group of agents of
+      the same race connected by touching houses,
+    - ``clusters``, ``largest_cluster`` and ``mean_cluster_size``: the
+      number of clusters, the size of the largest one and the mean size
+      of the cluster of an agent, the sum of the squared sizes over the
+      number of agents,
+    - ``interface_length``: number of pairs of touching houses occupied
+      by agents of different races,
+    - ``dissimilarity``: the multigroup dissimilarity index over the
+      blocks, 0 if the races are spread the same way in all the blocks,
+      1 if no block has two races,
+    - ``exposure``: the exposure indices over the blocks, the element
+      [m][n] is the average fraction of race n+1 in the block of an
+      agent of race m+1. The diagonal is the isolation index.
+
+    :param lattice: array of races with shape (width, height) and
+        0 for empty houses
+    :type lattice: numpy.ndarray
+    :param races: number of races, the largest race of the grid if None
+    :param block_size: side of the blocks, 5 if None
+    :param connectivity: 4 if the houses touch by their sides, 8 if they
+        also touch by their corners, 4 if None
+    :param torus: the grid wraps around at the edges
+    :rtype: dict
+    """
+    lattice = np.asarray(lattice)
+    width, height = lattice.shape
+    races = races or int(lattice.max())
+    block_size = block_size or 5
+    flat = lattice.ravel()
+
+    # one pass over the pairs of touching houses gives both
+    # the edges of the clusters and the interface
+    first, second = _pairs(_neighbourhood(width, height, connectivity or 4, torus))
+    races_first, races_second = flat[first], flat[second]
+    occupied = (races_first > 0) & (races_second > 0)
+    same = occupied & (races_first == races_second)
+    interface_length = int(np.count_nonzero(occupied & ~same))
+
+    labels = connected_components(width * height, first[same], second[same])
+    agents = np.flatnonzero(flat)
+    sizes = np.bincount(labels[agents], minlength=width * height)
+    roots = np.flatnonzero(sizes)
+    cluster_sizes = {
+        race: sorted(sizes[roots[flat[roots] == race]].tolist(), reverse=True)
+        for race in range(1, races + 1)
+        }
+
+    counts = _block_counts(lattice, races, block_size)
+    totals = counts.sum(axis=0)
+    race_totals = counts.sum(axis=1)
+    n_agents = int(race_totals.sum())
+    dissimilarity = 0.0
+    exposure = np.zeros((races, races))
+    if n_agents:
+        shares = race_totals / n_agents
+        interaction = float((shares * (1 - shares)).sum())
+        blocks = totals > 0
+        block_shares = counts[:, blocks] / totals[blocks]
+        if interaction:
+            dissimilarity = float(
+                (totals[blocks] * np.abs(block_shares - shares[:, None])).sum()
+                / (2 * n_agents * interaction)
+                )
+        with np.errstate(divide="ignore", invalid="ignore"):
+            exposure = (counts[:, blocks] / race_totals[:, None]) @ block_shares.T
+        exposure = np.nan_to_num(exposure)
+
+    return {
+        "agents": n_agents,
+        "cluster_sizes": cluster_sizes,
+        "clusters": len(roots),
+        "largest_cluster": int(sizes.max()) if n_agents else 0,
+        "mean_cluster_size": float((sizes ** 2).sum() / n_agents) if n_agents else 0.0,
+        "interface_length": interface_length,
+        "dissimilarity": dissimilarity,
+        "exposure": exposure.tolist()
+    }
+
+
+class Metrics():
+    """
+    Metrics measures the segregation of the grids of a model.
+
+    :meth:`at` measures the grid of a step when it is asked for and keeps
+    the result, so the metrics of a step are only computed once per run
+    of the model. :meth:`follow` measures the grid of a running model
+    every few steps, and with ``incremental`` it also keeps the interface
+    length of every step up to date from the moves of the step, which
+    costs a few operations per move instead of a pass over the grid.
+
+    :param model: the model
+    :type model: models.Schelling
+    :param every: :meth:`follow` measures every this many steps, 1 if None
+    :param block_size: side of the blocks of the dissimilarity and
+        exposure indices, see :func:`measure`
+    :param connectivity: 4 or 8, see :func:`measure`
+    :param incremental: :meth:`follow` updates the interface length of
+        every step from the moves
+
+    The models with the ``"full"`` history keep the 2d lists of the
+    heatmap, which are cropped to a square, so the grids of their past
+    steps are only known if the grid is square.
+    """
+    def __init__(
+        self, model, every = None, block_size = None, connectivity = None,
+        incremental = False
+    ):
+
+        if model.history == "full" and model.width != model.height:
+            raise Exception(
+                "The full history only keeps square grids, "
+                "use the delta or mmap history for the metrics"
+                )
+        self.model = model
+        self.every = every or 1
+        self.block_size = block_size or 5
+        self.connectivity = connectivity or 4
+        self.incremental = incremental
+        self.neighbourhood = _neighbourhood(
+            model.width, model.height, self.connectivity, model.neighbourhood.torus
+            )
+        # interface length of each step seen by follow with incremental on
+        self.interface_lengths = {}
+        self._measurements = {}
+        self._run_id = model.run_id
+        self._lattice = None
+        self._interface_length = None
+
+    def _check_run(self):
+        # the model was initialized again, the steps are not the same
+        if self.model.run_id != self._run_id:
+            self._measurements = {}
+            self.interface_lengths = {}
+            self._run_id = self.model.run_id
+
+    def at(self, step = None):
+        """
+        at returns the metrics of the grid of a step, see :func:`measure`
+
+        :param step: iteration, the current one if None
+        :type step: int
+        :rtype: dict
+        """
+        self._check_run()
+        if step is None:
+            step = self.model.current_iteration
+        if step in self._measurements:
+            return self._measurements[step]
+
+        lattice = self.model.grid(step)
+        if lattice is None:
+            raise Exception("No grid of iteration {} found".format(step))
+        measurement = measure(
+            lattice, self.model.races, self.block_size, self.connectivity,
+            self.model.neighbourhood.torus
+            )
+        measurement["iteration"] = step
+        self._measurements[step] = measurement
+
+        return measurement
+
+    def series(self, name):
+        """
+        series returns a metric of the steps measured so far
+
+        :param name: one of :data:`SCALAR_METRICS`
+        :return: the iterations and the values
+        :rtype: tuple
+        """
+        if name not in SCALAR_METRICS:
+            raise Exception("No metric {} found".format(name))
+        self._check_run()
+        if name == "interface_length" and self.interface_lengths:
+            steps = sorted(self.interface_lengths)
+            return steps, [self.interface_lengths[step] for step in steps]
+
+        steps = sorted(self._measurements)
+        return steps, [self._measurements[step][name] for step in steps]
+
+    def _interface_change(self, flat, race):
+        """
+        _interface_change is the number of agents of another race
+        touching the house
+        """
+        races = self._lattice[self.neighbourhood.neighbours(flat)]
+
+        return int(np.count_nonzero((races > 0) & (races != race)))
+
+    def _apply_moves(self, moves):
+        height = self.model.height
+        for (x, y), (new_x, new_y), race in moves:
+            flat, new_flat = x * height + y, new_x * height + new_y
+            self._interface_length -= self._interface_change(flat, race)
+            self._lattice[flat] = 0
+            self._interface_length += self._interface_change(new_flat, race)
+            self._lattice[new_flat] = race
+
+    def follow(self, steps):
+        """
+        follow measures the grids of a running model and yields the
+        records of the steps, with the ``interface_length`` added to every
+        record if ``incremental`` is on
+
+        :param steps: records of :meth:`models.Schelling.iter_evolve`,
+            with the moves if ``incremental`` is on
+        :type steps: iterable
+        """
+        self._check_run()
+        if self.incremental:
+            self._lattice = np.array(self.model.grid(), dtype=np.int8).ravel()
+            self._interface_length = self.at()["interface_length"]
+            self.interface_lengths[self.model.current_iteration] = self._interface_length
+
+        for step in steps:
+            if self.incremental:
+                if "moves" not in step:
+                    raise Exception(
+                        "The incremental interface length needs the moves, "
+                        "use iter_evolve(moves=True)"
+                        )
+                self._apply_moves(step["moves"])
+                step["interface_length"] = self._interface_length
+                self.interface_lengths[step["iteration"]] = self._interface_length
+            if step["iteration"] % self.every == 0:
+                self.at(step["iteration"])
+            yield step
@@ -1,7 +1,20 @@
+import collections
+import concurrent.futures
+import heapq
 import itertools
+import os
 import random
-import copy
 import logging
+import tempfile
+import time
+import uuid
+import weakref
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from encoding import decode_array, encode_array
+from history import DeltaHistory, TrajectoryFile
 
 # import matplotlib.pyplot as plt
 
@@ -9,6 +22,586 @@ logging.basicConfig()
 logger = logging.getLogger('models')
 logger.setLevel(logging.WARNING)
 
+# what iter_evolve keeps of each step, from the least to the most
+RECORD_LEVELS = ("none", "stats", "keyframes", "full")
+
+# kinds of neighbourhoods, see Neighbourhood
+NEIGHBOURHOODS = ("moore", "von_neumann")
+# neighbourhoods of up to this many houses keep the neighbours of every
+# house in a table
+NEIGHBOUR_TABLE_SIZE = 24
+# bytes the table of neighbours may take, larger grids compute the
+# neighbours from the offsets
+NEIGHBOUR_TABLE_MEMORY = 2 ** 25
+# neighbourhoods of this many houses or more are counted with summed-area
+# tables instead of one shifted slice per neighbour
+SUMMED_AREA_SIZE = 100
+# version of the encoding of model_state(compact=True) this code reads and writes
+COMPACT_FORMAT_VERSION = 1
+
+
+class VacancyIndex():
+    """
+    VacancyIndex holds the empty houses of the grid.
+
+    The houses are kept in an array together with the position of each
+    house in that array, so that testing membership, picking a random
+    empty house and removing a house are all O(1). A house is removed by
+    moving the last house into its slot.
+
+    :param width: width of the grid
+    :param height: height of the grid
+    :param houses: list of empty houses such as [(0,0), (0,1)]
+    """
+    def __init__(self, width, height, houses = None):
+
+        self.width = width
+        self.height = height
+        # flat index x * height + y of the houses, and the slot of each house
+        self._houses = np.zeros(width * height, dtype=np.int64)
+        self._slots = np.full(width * height, -1, dtype=np.int64)
+        self._size = 0
+        # spatial buckets of the houses, see enable_buckets
+        self.bucket_size = None
+        self._buckets = None
+
+        if houses:
+            houses = np.array(houses, dtype=np.int64).reshape(-1, 2)
+            flat = houses[:, 0] * height + houses[:, 1]
+            self._size = len(flat)
+            self._houses[:self._size] = flat
+            self._slots[flat] = np.arange(self._size)
+
+    @classmethod
+    def from_flat(cls, width, height, flat):
+        """
+        from_flat creates the index from flat indices x * height + y
+
+        :param flat: array of flat indices of the empty houses
+        :type flat: numpy.ndarray
+        """
+        index = cls(width, height)
+        index._size = len(flat)
+        index._houses[:index._size] = flat
+        index._slots[flat] = np.arange(index._size)
+        return index
+
+    def flat(self):
+        """flat returns the flat indices x * height + y of the houses"""
+        return self._houses[:self._size].copy()
+
+    def __len__(self):
+        return self._size
+
+    def __contains__(self, house):
+        return self._slots[house[0] * self.height + house[1]] >= 0
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self._size
+        if not 0 <= i < self._size:
+            raise IndexError("vacancy index out of range")
+        return divmod(int(self._houses[i]), self.height)
+
+    def __iter__(self):
+        for flat in self._houses[:self._size].tolist():
+            yield divmod(flat, self.height)
+
+    def append(self, house):
+        """append adds an empty house"""
+        flat = house[0] * self.height + house[1]
+        self._houses[self._size] = flat
+        self._slots[flat] = self._size
+        self._size += 1
+        if self._buckets is not None:
+            self._buckets.setdefault(self._bucket(*house), set()).add(flat)
+
+    def remove(self, house):
+        """remove removes an empty house by swapping in the last house"""
+        flat = house[0] * self.height + house[1]
+        slot = self._slots[flat]
+        if slot < 0:
+            raise ValueError("{} is not an empty house".format(house))
+        self._size -= 1
+        last = self._houses[self._size]
+        self._houses[slot] = last
+        self._slots[last] = slot
+        self._slots[flat] = -1
+        if self._buckets is not None:
+            self._buckets[self._bucket(*house)].discard(flat)
+
+    def _bucket(self, x, y):
+        return x // self.bucket_size, y // self.bucket_size
+
+    def enable_buckets(self, bucket_size = None):
+        """
+        enable_buckets also keeps the houses in square buckets of the grid,
+        so that :meth:`nearest` only looks at the buckets around a house
+
+        :param bucket_size: width of the buckets
+        :type bucket_size: int
+        """
+        self.bucket_size = bucket_size or 8
+        self._buckets = {}
+        for flat in self._houses[:self._size].tolist():
+            x, y = divmod(flat, self.height)
+            self._buckets.setdefault(self._bucket(x, y), set()).add(flat)
+
+    def nearest(self, house, n):
+        """
+        nearest returns the n empty houses closest to the house, sorted by
+        distance. The buckets are visited in rings around the bucket of the
+        house until the next ring can not have closer houses.
+
+        :param house: coordinates of the house
+        :type house: tuple
+        :param n: number of houses
+        :type n: int
+        :rtype: list
+        """
+        if self._buckets is None:
+            self.enable_buckets()
+        x, y = house
+        bx, by = self._bucket(x, y)
+        n_rings = max(self.width, self.height) // self.bucket_size + 1
+        found = []
+        for ring in range(n_rings + 1):
+            # houses of this ring are at least this far along one axis
+            if len(found) >= n and found[n - 1][0] <= ((ring - 1) * self.bucket_size) ** 2:
+                break
+            for i in range(bx - ring, bx + ring + 1):
+                for j in range(by - ring, by + ring + 1):
+                    if max(abs(i - bx), abs(j - by)) != ring:
+                        continue
+                    for flat in self._buckets.get((i, j), ()):
+                        hx, hy = divmod(flat, self.height)
+                        found.append(((hx - x) ** 2 + (hy - y) ** 2, hx, hy))
+            found.sort()
+
+        return [(hx, hy) for _, hx, hy in found[:n]]
+
+    def to_list(self):
+        """to_list returns the empty houses as a list of [x, y]"""
+        houses = self._houses[:self._size]
+        return np.stack(divmod(houses, self.height), axis=1).tolist()
+
+
+class Neighbourhood():
+    """
+    Neighbourhood holds the houses whose agents are the neighbours of an
+    agent.
+
+    The Moore neighbourhood of radius r is the square of 2r+1 houses on
+    each side around the house, the von Neumann neighbourhood the houses
+    at a Manhattan distance of at most r. On a torus the grid wraps
+    around at the edges, otherwise the houses outside of the grid are
+    left out.
+
+    The neighbours of a house are given as flat indices
+    ``x * height + y``. For small radii and grids they are read from a
+    table built once for the whole grid, otherwise the table would take
+    too much memory and they are computed from the offsets. The neighbour
+    counts of the whole grid are summed with one shifted slice per offset
+    for small radii, and with summed-area tables for large radii, which
+    cost the same for any radius. The rows of the von Neumann diamond are
+    summed with prefix sums along the rows, O(r) per house.
+
+    :param width: width of the grid
+    :param height: height of the grid
+    :param kind: ``"moore"`` or ``"von_neumann"``, moore if None
+    :param radius: radius of the neighbourhood, 1 if None
+    :param torus: wrap the grid around at the edges
+    """
+    def __init__(self, width, height, kind = None, radius = None, torus = False):
+
+        self.width = width
+        self.height = height
+        self.kind = kind or "moore"
+        if self.kind not in NEIGHBOURHOODS:
+            raise Exception("No neighbourhood {} found".format(self.kind))
+        self.radius = radius or 1
+        self.torus = torus
+        if torus and 2 * self.radius + 1 > min(width, height):
+            raise Exception(
+                "The torus needs at least 2 * radius + 1 houses on each side of the grid"
+                )
+
+        r = self.radius
+        self.offsets = [
+            (dx, dy)
+            for dy in range(-r, r + 1) for dx in range(-r, r + 1)
+            if (dx, dy) != (0, 0) and (self.kind == "moore" or abs(dx) + abs(dy) <= r)
+            ]
+        self._dx = np.array([dx for dx, _ in self.offsets], dtype=np.int64)
+        self._dy = np.array([dy for _, dy in self.offsets], dtype=np.int64)
+        # the neighbours of the houses away from the edges
+        self._flat_offsets = self._dx * height + self._dy
+        self.small = len(self.offsets) <= NEIGHBOUR_TABLE_SIZE
+        self.table = self.small and (
+            4 * len(self.offsets) * width * height <= NEIGHBOUR_TABLE_MEMORY
+            )
+        self.summed_area = len(self.offsets) >= SUMMED_AREA_SIZE
+        self.count_dtype = np.int16 if len(self.offsets) < 2 ** 15 else np.int32
+        # neighbour table, see _build_table
+        self._indptr = None
+        self._indices = None
+
+    def houses(self, x, y):
+        """
+        houses lists the neighbours of the house (x, y) as coordinates
+
+        :rtype: list
+        """
+        width, height = self.width, self.height
+        if self.torus:
+            return [((x + dx) % width, (y + dy) % height) for dx, dy in self.offsets]
+
+        return [
+            (x + dx, y + dy) for dx, dy in self.offsets
+            if 0 <= x + dx < width and 0 <= y + dy < height
+            ]
+
+    def _flat_neighbours(self, xs, ys):
+        """
+        _flat_neighbours returns the flat indices of the neighbours of the
+        houses (xs, ys), one row per house, and whether they are on the grid
+        """
+        nx = xs[:, None] + self._dx
+        ny = ys[:, None] + self._dy
+        if self.torus:
+            nx %= self.width
+            ny %= self.height
+            on_grid = np.ones(nx.shape, dtype=np.bool_)
+        else:
+            on_grid = (nx >= 0) & (nx < self.width) & (ny >= 0) & (ny < self.height)
+
+        return nx * self.height + ny, on_grid
+
+    def _build_table(self):
+        """
+        _build_table lists the neighbours of every house. On a torus every
+        house has all the neighbours, and the neighbours of the house i are
+        the row ``_indices[i]``. Otherwise the houses on the edges have
+        fewer, and the neighbours are ``_indices[_indptr[i]:_indptr[i+1]]``.
+        """
+        n_houses = self.width * self.height
+        counts = []
+        indices = []
+        # in blocks, to bound the memory of the intermediate arrays
+        for start in range(0, n_houses, 65536):
+            xs, ys = np.divmod(np.arange(start, min(start + 65536, n_houses)), self.height)
+            flat, on_grid = self._flat_neighbours(xs, ys)
+            if self.torus:
+                indices.append(flat.astype(np.int32))
+            else:
+                counts.append(on_grid.sum(axis=1))
+                indices.append(flat[on_grid].astype(np.int32))
+
+        if not self.torus:
+            self._indptr = np.concatenate(
+                [[0], np.cumsum(np.concatenate(counts))]
+                ).astype(np.int32)
+        self._indices = np.concatenate(indices)
+
+    def neighbours(self, flat):
+        """
+        neighbours returns the flat indices of the neighbours of a house
+
+        :param flat: flat index ``x * height + y`` of the house
+        :type flat: int
+        :rtype: numpy.ndarray
+        """
+        if self.table:
+            if self._indices is None:
+                self._build_table()
+            if self.torus:
+                return self._indices[flat]
+            return self._indices[self._indptr[flat]:self._indptr[flat + 1]]
+
+        x, y = divmod(flat, self.height)
+        r = self.radius
+        if r <= x < self.width - r and r <= y < self.height - r:
+            return flat + self._flat_offsets
+        flat, on_grid = self._flat_neighbours(np.array([x]), np.array([y]))
+
+        return flat[on_grid]
+
+    def _padded(self, lattice, x0, x1):
+        """
+        _padded returns the rows x0 to x1 of the lattice with a margin of
+        radius houses on each side: the houses on the other side of the
+        grid on a torus, empty houses outside of the grid otherwise
+        """
+        r = self.radius
+        width, height = lattice.shape[-2:]
+        batch = lattice.shape[:-2]
+        if self.torus:
+            rows = lattice.take(range(x0 - r, x1 + r), axis=-2, mode="wrap")
+            return np.pad(rows, ((0, 0),) * (lattice.ndim - 1) + ((r, r),), mode="wrap")
+
+        padded = np.zeros(batch + (x1 - x0 + 2 * r, height + 2 * r), dtype=lattice.dtype)
+        h0, h1 = max(x0 - r, 0), min(x1 + r, width)
+        padded[..., h0 - x0 + r:h1 - x0 + r, r:r + height] = lattice[..., h0:h1, :]
+
+        return padded
+
+    def _window_sums(self, mask, rows, columns):
+        """
+        _window_sums sums the padded mask over the neighbourhood of every
+        house, including the house itself, with a summed-area table for the
+        Moore neighbourhood and prefix sums of the rows for von Neumann
+        """
+        r = self.radius
+        batch = mask.shape[:-2]
+        if self.kind == "moore":
+            table = np.zeros(
+                batch + (mask.shape[-2] + 1, mask.shape[-1] + 1), dtype=np.int32
+                )
+            table[..., 1:, 1:] = mask.cumsum(axis=-2, dtype=np.int32).cumsum(axis=-1)
+            size = 2 * r + 1
+            return (
+                table[..., size:size + rows, size:size + columns]
+                - table[..., :rows, size:size + columns]
+                - table[..., size:size + rows, :columns]
+                + table[..., :rows, :columns]
+            )
+
+        prefix = np.zeros(batch + (mask.shape[-2], mask.shape[-1] + 1), dtype=np.int32)
+        prefix[..., 1:] = mask.cumsum(axis=-1, dtype=np.int32)
+        sums = np.zeros(batch + (rows, columns), dtype=np.int32)
+        for dx in range(-r, r + 1):
+            half = r - abs(dx)
+            row = slice(r + dx, r + dx + rows)
+            sums += (
+                prefix[..., row, r + half + 1:r + half + 1 + columns]
+                - prefix[..., row, r - half:r - half + columns]
+            )
+
+        return sums
+
+    def counts(self, lattice, x0 = 0, x1 = None):
+        """
+        counts counts the occupied neighbours and the neighbours of the
+        same race of the houses of the rows x0 to x1 of the lattice.
+        Empty houses have no similar neighbours.
+
+        :param lattice: array of races with shape (width, height) and
+            0 for empty houses, or a batch of them with shape
+            (replicas, width, height)
+        :type lattice: numpy.ndarray
+        :param x0: first row
+        :param x1: end of the rows, the last row of the lattice if None
+        :return: occupied neighbour counts and similar neighbour counts
+        :rtype: tuple
+        """
+        if x1 is None:
+            x1 = lattice.shape[-2]
+        r = self.radius
+        shape = lattice.shape[:-2] + (x1 - x0, lattice.shape[-1])
+        rows, columns = shape[-2:]
+        padded = self._padded(lattice, x0, x1)
+        center = padded[..., r:r + rows, r:r + columns]
+
+        if self.summed_area:
+            occupied = center > 0
+            occupied_counts = self._window_sums(padded > 0, rows, columns) - occupied
+            similar_counts = np.zeros(shape, dtype=np.int32)
+            for race in np.unique(center[occupied]).tolist():
+                same = center == race
+                similar_counts[same] = (
+                    self._window_sums(padded == race, rows, columns)[same] - 1
+                    )
+            return (
+                occupied_counts.astype(self.count_dtype),
+                similar_counts.astype(self.count_dtype)
+            )
+
+        occupied = padded > 0
+        occupied_counts = np.zeros(shape, dtype=self.count_dtype)
+        similar_counts = np.zeros(shape, dtype=self.count_dtype)
+        for dx, dy in self.offsets:
+            window = (
+                Ellipsis, slice(r + dx, r + dx + rows), slice(r + dy, r + dy + columns)
+            )
+            occupied_counts += occupied[window]
+            similar_counts += occupied[window] & (padded[window] == center)
+
+        return occupied_counts, similar_counts
+
+
+class StepProfiler():
+    """
+    StepProfiler measures the wall time of the phases of a step.
+
+    :meth:`lap` adds the time since the previous lap to a phase. It does
+    nothing if the profiler is disabled, so it can stay in the hot loops.
+
+    :param enabled: whether to measure the phases
+    """
+    def __init__(self, enabled):
+
+        self.enabled = enabled
+        self.phases = {}
+        self._last = time.perf_counter() if enabled else None
+
+    def lap(self, phase):
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        self.phases[phase] = self.phases.get(phase, 0.0) + now - self._last
+        self._last = now
+
+
+# shared memory segments attached by the worker processes, by name
+_ATTACHED_SEGMENTS = {}
+
+
+def _shared_arrays(layout):
+    """
+    _shared_arrays attaches the arrays of a :class:`SharedLattice`
+    in a worker process
+    """
+    arrays = {}
+    for key, (name, dtype) in layout["segments"].items():
+        segment = _ATTACHED_SEGMENTS.get(name)
+        if segment is None:
+            segment = shared_memory.SharedMemory(name=name)
+            _ATTACHED_SEGMENTS[name] = segment
+        arrays[key] = np.ndarray(layout["shape"], dtype=dtype, buffer=segment.buf)
+
+    return arrays
+
+
+def _stripe_neighbour_counts(layout, x0, x1):
+    """
+    _stripe_neighbour_counts counts the neighbours of the rows x0 to x1
+    of the shared lattice, using the rows within the radius of the
+    neighbourhood around the stripe as a halo
+
+    :return: sum of the similarities of the agents of the stripe
+    :rtype: float
+    """
+    arrays = _shared_arrays(layout)
+    lattice = arrays["lattice"]
+    neighbourhood = Neighbourhood(*layout["shape"], *layout["neighbourhood"])
+    occupied_counts, similar_counts = neighbourhood.counts(lattice, x0, x1)
+    arrays["occupied_counts"][x0:x1] = occupied_counts
+    arrays["similar_counts"][x0:x1] = similar_counts
+
+    similarity = similar_counts / np.maximum(occupied_counts, 1)
+    return float(np.where(lattice[x0:x1] > 0, similarity, 0.0).sum())
+
+
+def _stripe_unsatisfied_mask(layout, x0, x1, neighbour_similarity):
+    """
+    _stripe_unsatisfied_mask finds the unsatisfied agents of the rows x0
+    to x1 from the shared neighbour counts
+    """
+    arrays = _shared_arrays(layout)
+    occupied_counts = arrays["occupied_counts"][x0:x1]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        similarity = arrays["similar_counts"][x0:x1] / occupied_counts
+
+    arrays["mask"][x0:x1] = (occupied_counts > 0) & (similarity < neighbour_similarity)
+
+
+def _release_shared(executor, segments):
+    executor.shutdown(wait=True)
+    for segment in segments:
+        try:
+            segment.close()
+        except BufferError:
+            # arrays still use the memory, it is freed with them
+            pass
+        segment.unlink()
+
+
+class SharedLattice():
+    """
+    SharedLattice keeps the lattice and the neighbour counts of the numpy
+    engine in shared memory, split into stripes of rows that a pool of
+    processes works on in parallel.
+
+    Only the phases that read the whole grid are parallel: counting the
+    neighbours, which needs the rows next to each stripe as a halo, and
+    finding the unsatisfied agents. The moves are done by the model in the
+    main process directly on the shared arrays, so an agent can move to
+    any empty house of the grid.
+
+    :param width: width of the grid
+    :param height: height of the grid
+    :param workers: number of processes and of stripes
+    :param neighbourhood: neighbourhood of the model
+    :type neighbourhood: Neighbourhood
+    """
+    def __init__(self, width, height, workers, neighbourhood):
+
+        self.width = width
+        self.height = height
+        self.workers = workers
+        self.stripes = [
+            (int(rows[0]), int(rows[-1]) + 1)
+            for rows in np.array_split(np.arange(width), workers) if len(rows)
+            ]
+
+        self._segments = []
+        self._layout = {
+            "shape": (width, height),
+            "neighbourhood": (neighbourhood.kind, neighbourhood.radius, neighbourhood.torus),
+            "segments": {}
+        }
+        self.lattice = self._allocate("lattice", np.int8)
+        self.occupied_counts = self._allocate("occupied_counts", neighbourhood.count_dtype)
+        self.similar_counts = self._allocate("similar_counts", neighbourhood.count_dtype)
+        self.mask = self._allocate("mask", np.bool_)
+
+        self._executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+        self._finalizer = weakref.finalize(
+            self, _release_shared, self._executor, self._segments
+            )
+
+    def _allocate(self, key, dtype):
+        dtype = np.dtype(dtype)
+        segment = shared_memory.SharedMemory(
+            create=True, size=max(self.width * self.height * dtype.itemsize, 1)
+            )
+        self._segments.append(segment)
+        self._layout["segments"][key] = (segment.name, dtype.str)
+        array = np.ndarray((self.width, self.height), dtype=dtype, buffer=segment.buf)
+        array[:] = 0
+
+        return array
+
+    def _map(self, func, *args):
+        futures = [
+            self._executor.submit(func, self._layout, x0, x1, *args)
+            for x0, x1 in self.stripes
+            ]
+        return [future.result() for future in futures]
+
+    def neighbour_counts(self):
+        """
+        neighbour_counts fills the neighbour counts from the lattice
+
+        :return: sum of the similarities of all the agents
+        :rtype: float
+        """
+        return sum(self._map(_stripe_neighbour_counts))
+
+    def unsatisfied_mask(self, neighbour_similarity):
+        """
+        unsatisfied_mask fills and returns the mask of unsatisfied agents
+
+        :rtype: numpy.ndarray
+        """
+        self._map(_stripe_unsatisfied_mask, neighbour_similarity)
+
+        return self.mask
+
+    def close(self):
+        """close stops the processes and frees the shared memory"""
+        self._finalizer()
+
 
 class Schelling():
     """
@@ -19,13 +612,77 @@ class Schelling():
     :param width: width of the grid to put living spaces
     :param height: height of the grid to put living spaces
     :param empty_house_rate: percentage of houses that are empty
+    :param engine: ``"dict"`` keeps the original per-agent dictionary
+        engine, ``"numpy"`` stores the grid as a 2d array and counts
+        neighbours with array arithmetic. Both give the same results.
+    :param schedule: ``"full"`` visits every agent on each step,
+        ``"frontier"`` only visits the agents whose neighbourhood changed
+        since they were last found satisfied (numpy engine only).
+        Both give the same results.
+    :param format: ``"compact"`` if the model was saved with
+        ``model_state(compact=True)``
+    :param format_version: version of the compact encoding, only
+        ``COMPACT_FORMAT_VERSION`` can be read
+    :param history: ``"full"`` saves the grid of every step in ``data``,
+        ``"delta"`` only saves the moves of every step and a keyframe of
+        the grid every ``keyframe_interval`` steps, ``"mmap"`` writes the
+        grid of every step to the memory mapped file ``trajectory``,
+        see :class:`history.TrajectoryFile`.
+    :param trajectory: path of the file of the ``"mmap"`` history,
+        a new file in the temporary directory if None
+    :param workers: number of processes counting the neighbours and
+        finding the unsatisfied agents on stripes of the grid held in
+        shared memory (numpy engine only), see :class:`SharedLattice`.
+        The moves are still done one by one, so the results are the same.
+        Call :meth:`close` to stop the processes.
+    :param update: ``"sequential"`` moves the agents one after the other,
+        each one seeing the moves before it. ``"synchronous"`` evaluates
+        all the agents on the same grid and moves them at once with array
+        operations, see :meth:`_evolve_one_synchronous` (numpy engine, full
+        schedule and random relocation only). The results differ from
+        the sequential update.
+    :param relocation: where unsatisfied agents move: ``"random"`` to a
+        random empty house, ``"best_of_k"`` to the best of
+        ``relocation_k`` random empty houses, ``"nearest"`` to the nearest
+        empty house where they are satisfied among the ``relocation_k``
+        nearest ones, or a random one if there is none,
+        see :meth:`_choose_house`
+    :param relocation_k: number of empty houses looked at
+    :param cycle_detection: keep a Zobrist hash of the grid, updated with
+        the moves of each step, and stop :meth:`iter_evolve` when the grid
+        is the same as at an earlier step
+    :param plateau_window: stop :meth:`iter_evolve` when the averages of
+        the first and the second half of this many steps differ by at most
+        ``plateau_tolerance`` for the order parameter and by at most
+        ``plateau_changes_tolerance`` times the average for the number of
+        changes. Averages are used since both fluctuate when agents keep
+        moving. Off if 0 or None.
+    :param profile: record the wall time of the phases of each step
+        and the number of agents evaluated and moved in ``profiles``,
+        see :meth:`_record_step`.
+    :param neighbourhood: ``"moore"`` counts the houses of the square
+        around an agent as its neighbours, ``"von_neumann"`` the houses
+        at a Manhattan distance of at most ``radius``,
+        see :class:`Neighbourhood`
+    :param radius: radius of the neighbourhood, 1 by default
+    :param torus: wrap the grid around at the edges, so that the agents
+        on an edge have the agents on the opposite edge as neighbours
+    :param seed: seed of the random number generator of the model.
+        The state of the generator is saved by :meth:`model_state`, so a
+        reloaded model continues with the same random numbers.
     :param :
     """
-    def __init__(self, model = None):
+    def __init__(self, model = None, engine = None):
 
         if model is None:
             model = {"races": 2}
 
+        if model.get("format") == "compact" \
+                and model.get("format_version", 1) != COMPACT_FORMAT_VERSION:
+            raise Exception(
+                "No compact format version {} found".format(model.get("format_version"))
+                )
+
         # {
         #     "width": self.width,
         #     "height": self.height,
@@ -43,21 +700,29 @@ class Schelling():
             agents = {}
         else:
             agents = self._reload_agents(model.get('agents'))
-            print("Using agents: ", agents)
+            logger.debug("Using agents: {}".format(agents))
 
         if model.get("empty_house_rate") is None:
             empty_house_rate = 0.2
         else:
             empty_house_rate = model.get("empty_house_rate")
 
+        self.width = model.get("width") or 20
+        self.height = model.get("height") or 20
+
         if not model.get("empty_houses"):
-            empty_houses = []
+            empty_houses = VacancyIndex(self.width, self.height)
+        elif model.get("format") == "compact":
+            empty_houses = VacancyIndex.from_flat(
+                self.width, self.height,
+                decode_array(model.get("empty_houses"), np.uint32).astype(np.int64)
+                )
         else:
             empty_houses = model.get("empty_houses")
-            empty_houses = [tuple(i) for i in empty_houses]
+            empty_houses = VacancyIndex(
+                self.width, self.height, [tuple(i) for i in empty_houses]
+                )
 
-        self.width = model.get("width") or 20
-        self.height = model.get("height") or 20
         self.races = model.get("races") or 2
         self.empty_house_rate = empty_house_rate
         self.neighbour_similarity = model.get("neighbour_similarity") or 0.6
@@ -66,12 +731,91 @@ class Schelling():
         # agents are gonna live in the houses
         self.agents = agents
         self.data = model.get("data") or {}
+        if model.get("format") == "compact":
+            self.data = {
+                int(step): decode_array(frame, np.uint8, (self.height, self.width)).tolist()
+                for step, frame in self.data.items()
+                }
         self.changes = model.get("changes") or []
         self.order_parameters = model.get("order_parameters") or []
         self.current_iteration = model.get('current_iteration') or 0
+        # new for every initialize, the frames of a run never change
+        self.run_id = model.get("run_id")
+        self.engine = engine or model.get("engine") or "dict"
+        if self.engine not in ("dict", "numpy"):
+            raise Exception("No engine {} found".format(self.engine))
+        self.schedule = model.get("schedule") or "full"
+        if self.schedule not in ("full", "frontier"):
+            raise Exception("No schedule {} found".format(self.schedule))
+        if self.schedule == "frontier" and self.engine != "numpy":
+            raise Exception("The frontier schedule requires the numpy engine")
+
+        self.history = model.get("history") or "full"
+        if self.history not in ("full", "delta", "mmap"):
+            raise Exception("No history {} found".format(self.history))
+        self.keyframe_interval = model.get("keyframe_interval") or 10
+        self.relocation = model.get("relocation") or "random"
+        if self.relocation not in ("random", "best_of_k", "nearest"):
+            raise Exception("No relocation {} found".format(self.relocation))
+        self.relocation_k = model.get("relocation_k") or 16
+        self.update = model.get("update") or "sequential"
+        if self.update not in ("sequential", "synchronous"):
+            raise Exception("No update {} found".format(self.update))
+        if self.update == "synchronous" and (
+            self.engine != "numpy" or self.schedule != "full" or self.relocation != "random"
+        ):
+            raise Exception(
+                "The synchronous update requires the numpy engine, "
+                "the full schedule and the random relocation"
+                )
+        if self.relocation == "nearest":
+            self.empty_houses.enable_buckets()
+        self.neighbourhood = Neighbourhood(
+            self.width, self.height, model.get("neighbourhood"), model.get("radius"),
+            model.get("torus") or False
+            )
+        if model.get("delta_history"):
+            self.delta_history = DeltaHistory.from_state(model.get("delta_history"))
+        else:
+            self.delta_history = None
+        self.trajectory_path = model.get("trajectory")
+        self.trajectory = None
+        if self.history == "mmap" and model.get("agents"):
+            self.trajectory = TrajectoryFile(self.trajectory_path, mode="a")
+            # the file may have frames of steps after this state
+            self.trajectory.truncate(self.current_iteration + 1)
+
+        # record level of the running iter_evolve
+        self._record = "full"
+        self.profile = model.get("profile") or False
+        self.profiles = model.get("profiles") or []
+        self.seed = model.get("seed")
+        self.rng = random.Random(self.seed)
+        if model.get("rng_state"):
+            self.rng.setstate(self._reload_rng_state(model.get("rng_state")))
+
+        self.workers = model.get("workers") or 1
+        if self.workers > 1 and self.engine != "numpy":
+            raise Exception("The parallel mode requires the numpy engine")
+        self._shared = None
+
+        self.lattice = None
+        if self.engine == "numpy" and self.agents:
+            self._build_lattice()
+
+        self.cycle_detection = model.get("cycle_detection") or False
+        self.plateau_window = model.get("plateau_window") or 0
+        self.plateau_tolerance = model.get("plateau_tolerance") or 5e-3
+        self.plateau_changes_tolerance = model.get("plateau_changes_tolerance") or 0.1
+        self.stop_reason = model.get("stop_reason")
+        # hash of the grid of each iteration, see _lattice_hash
+        self.lattice_hashes = model.get("lattice_hashes") or []
+        self._zobrist_table = None
+        self._hash_iterations = {h: i for i, h in enumerate(self.lattice_hashes)}
+        self._revisited = None
 
     @staticmethod
-    def _distribute_houses(locations, empty_house_rate):
+    def _distribute_houses(locations, empty_house_rate, rng = None):
         """
         _distribute_houses will distribute houses on the list of locations
 
@@ -81,9 +825,13 @@ class Schelling():
 
         :param locations: list of locations such as [(0,0), (0,1)]
         :type locations: list
+        :param rng: random number generator, the random module if None
+        :type rng: random.Random
         """
+        if rng is None:
+            rng = random
 
-        random.shuffle(locations)
+        rng.shuffle(locations)
         empty_houses_count = int(empty_house_rate * len(locations))
 
         empty_houses = locations[:empty_houses_count]
@@ -145,37 +893,209 @@ class Schelling():
 
         return res
 
+    @staticmethod
+    def _lattice_to_2d_array(lattice, width, height):
+        """
+        _lattice_to_2d_array converts the lattice of the numpy engine to
+        the same 2d list as :meth:`_agents_dict_to_2d_array`
+
+        :param lattice: array of races with shape (width, height)
+        :type lattice: numpy.ndarray
+        :param width: width of the grid
+        :type width: int
+        :param height: height of the grid
+        :type height: int
+        :return: 2d list of the grid with each value being the agent race
+        :rtype: list
+        """
+        res = np.zeros((height, width), dtype=lattice.dtype)
+        # rows are indexed by x, the same as _agents_dict_to_2d_array
+        size = min(width, height)
+        res[:size, :size] = lattice[:size, :size]
+
+        return res.tolist()
+
+    def _build_lattice(self):
+        """
+        _build_lattice fills the lattice of the numpy engine from the agents
+        """
+        if self.workers > 1:
+            if self._shared is None:
+                self._shared = SharedLattice(
+                    self.width, self.height, self.workers, self.neighbourhood
+                    )
+            self._shared.lattice[:] = self._agents_lattice()
+            self.lattice = self._shared.lattice
+            self._occupied_counts = self._shared.occupied_counts
+            self._similar_counts = self._shared.similar_counts
+        else:
+            self.lattice = self._agents_lattice()
+        self._count_neighbours()
+
+        # rank of each agent in the order of self.agents, -1 for empty houses
+        self._rank = np.full((self.width, self.height), -1, dtype=np.int64)
+        if self.agents:
+            houses = np.array(list(self.agents.keys()))
+            self._rank[houses[:, 0], houses[:, 1]] = np.arange(len(houses))
+        self._next_rank = len(self.agents)
+        if self.schedule == "frontier":
+            self._frontier = set(
+                map(tuple, np.argwhere(self._unsatisfied_mask()).tolist())
+                )
+
+    def _count_neighbours(self):
+        """
+        _count_neighbours computes the neighbour counts and the sum of the
+        similarities from the lattice, on the processes of the parallel
+        mode if there are
+        """
+        if self._shared is not None:
+            self._similarity_sum = self._shared.neighbour_counts()
+            return
+
+        self._occupied_counts, self._similar_counts = self.neighbourhood.counts(
+            self.lattice
+            )
+        self._similarity_sum = float(self._similarities().sum())
+
+    def _agents_lattice(self):
+        """
+        _agents_lattice converts the agents dictionary to an array of races
+        with shape (width, height)
+        """
+        lattice = np.zeros((self.width, self.height), dtype=np.int8)
+        if self.agents:
+            houses = np.array(list(self.agents.keys()))
+            lattice[houses[:, 0], houses[:, 1]] = list(self.agents.values())
+
+        return lattice
+
     @staticmethod
     def _serialize_agents(agents):
 
         return [{'key':k, 'value': v} for k, v in agents.items()]
 
+    @staticmethod
+    def _serialize_agents_compact(agents, width, height):
+        """
+        _serialize_agents_compact saves the agents as a grid of races and
+        the order of the houses in the agents dictionary, both encoded
+        with :func:`encoding.encode_array`
+        """
+        grid = np.zeros(width * height, dtype=np.uint8)
+        order = np.array(
+            [x * height + y for x, y in agents.keys()], dtype=np.int64
+            )
+        grid[order] = list(agents.values())
+
+        return {
+            "width": width,
+            "height": height,
+            "grid": encode_array(grid, np.uint8),
+            "order": encode_array(order, np.uint32)
+        }
+
     @staticmethod
     def _reload_agents(key_val):
 
+        if isinstance(key_val, dict):
+            # saved by _serialize_agents_compact
+            height = key_val.get("height")
+            grid = decode_array(key_val.get("grid"), np.uint8)
+            order = decode_array(key_val.get("order"), np.uint32).astype(np.int64)
+            xs, ys = divmod(order, height)
+            return dict(zip(zip(xs.tolist(), ys.tolist()), grid[order].tolist()))
+
         tuple_keys_dict = {tuple(i.get("key")): i.get("value") for i in key_val}
 
         return tuple_keys_dict
 
-    def model_state(self):
+    @staticmethod
+    def _reload_rng_state(rng_state):
+        """
+        _reload_rng_state converts the state of the random number generator
+        saved by :meth:`model_state` back to the tuple of ``getstate``
+        """
+        version, internal, gauss = rng_state
+        if isinstance(internal, str):
+            internal = decode_array(internal, np.uint32).tolist()
+
+        return version, tuple(internal), gauss
+
+    def model_state(self, compact = False):
         """save the current status of the model
+
+        :param compact: save the houses, the grids and the history as
+            compressed binary arrays encoded in strings instead of lists.
+            The state is much smaller and faster to load,
+            and it is still json serializable.
+        :type compact: bool
         """
-        # generate all possible combinations of the horizontal and vertical coordinates
-        return {
+        state = {
             "width": self.width,
             "height": self.height,
             "races": self.races,
             "empty_house_rate": self.empty_house_rate,
             "neighbour_similarity": self.neighbour_similarity,
             "n_iterations": self.n_iterations,
-            "empty_houses": self.empty_houses,
-            "agents": self._serialize_agents(self.agents),
-            "data": self.data,
             "changes": self.changes,
             "order_parameters": self.order_parameters,
-            "current_iteration": self.current_iteration
+            "current_iteration": self.current_iteration,
+            "run_id": self.run_id,
+            "engine": self.engine,
+            "schedule": self.schedule,
+            "history": self.history,
+            "trajectory": self.trajectory_path,
+            "keyframe_interval": self.keyframe_interval,
+            "update": self.update,
+            "relocation": self.relocation,
+            "relocation_k": self.relocation_k,
+            "neighbourhood": self.neighbourhood.kind,
+            "radius": self.neighbourhood.radius,
+            "torus": self.neighbourhood.torus,
+            "workers": self.workers,
+            "cycle_detection": self.cycle_detection,
+            "plateau_window": self.plateau_window,
+            "plateau_tolerance": self.plateau_tolerance,
+            "plateau_changes_tolerance": self.plateau_changes_tolerance,
+            "stop_reason": self.stop_reason,
+            "lattice_hashes": self.lattice_hashes,
+            "profile": self.profile,
+            "profiles": self.profiles,
+            "seed": self.seed
         }
 
+        rng_version, rng_internal, rng_gauss = self.rng.getstate()
+        if compact:
+            state.update({
+                "format": "compact",
+                "format_version": COMPACT_FORMAT_VERSION,
+                "empty_houses": encode_array(self.empty_houses.flat(), np.uint32),
+                "agents": self._serialize_agents_compact(
+                    self.agents, self.width, self.height
+                    ) if self.agents else [],
+                "data": {
+                    step: encode_array(frame, np.uint8)
+                    for step, frame in self.data.items()
+                    },
+                "delta_history": self.delta_history and self.delta_history.state(
+                    compact=True
+                    ),
+                "rng_state": [
+                    rng_version, encode_array(rng_internal, np.uint32), rng_gauss
+                    ]
+            })
+        else:
+            state.update({
+                "empty_houses": self.empty_houses.to_list(),
+                "agents": self._serialize_agents(self.agents),
+                "data": self.data,
+                "delta_history": self.delta_history and self.delta_history.state(),
+                "rng_state": [rng_version, list(rng_internal), rng_gauss]
+            })
+
+        return state
+
     def initialize(self):
         """allocate occupied and empty houses to to grid
         and populate agents of each race to the occupied houses
@@ -184,9 +1104,12 @@ class Schelling():
         self.all_houses = list(itertools.product(range(self.width),range(self.height)))
 
         # allocate houses on the grid:
-        self.empty_houses, self.occupied_houses = self._distribute_houses(
-            self.all_houses, self.empty_house_rate
+        empty_houses, self.occupied_houses = self._distribute_houses(
+            self.all_houses, self.empty_house_rate, self.rng
             )
+        self.empty_houses = VacancyIndex(self.width, self.height, empty_houses)
+        if self.relocation == "nearest":
+            self.empty_houses.enable_buckets()
         houses_by_agent_race = list(self._distribute_races_to_house(
             self.occupied_houses, self.races
         ))
@@ -199,14 +1122,116 @@ class Schelling():
                 )
 
         self.current_iteration = 0
-        self.data = {
-            0: self._agents_dict_to_2d_array(self.agents, self.width, self.height)
-        }
+        self.run_id = uuid.uuid4().hex
+        if self.engine == "numpy":
+            self._build_lattice()
+        self.stop_reason = None
+        self.lattice_hashes = []
+        self._hash_iterations = {}
+        if self.cycle_detection:
+            self._add_lattice_hash(self._lattice_hash(self._current_lattice()))
+        if self.history == "delta":
+            self.delta_history = DeltaHistory(
+                self.width, self.height, self.keyframe_interval
+                )
+            self.delta_history.start(self._current_lattice())
+            self.data = {}
+        elif self.history == "mmap":
+            if self.trajectory_path is None:
+                fd, self.trajectory_path = tempfile.mkstemp(
+                    prefix="schelling-", suffix=".trajectory"
+                    )
+                os.close(fd)
+            if self.trajectory is not None:
+                self.trajectory.close()
+            self.trajectory = TrajectoryFile(
+                self.trajectory_path, self.width, self.height, mode="w"
+                )
+            self.trajectory.append(self._current_lattice())
+            self._write_trajectory_metadata()
+            self.data = {}
+        else:
+            self.data = {
+                0: self._snapshot()
+            }
+
+    def _current_lattice(self):
+        """
+        _current_lattice returns the current grid as an array of races
+        with shape (width, height)
+        """
+        if self.engine == "numpy":
+            return self.lattice
+
+        return self._agents_lattice()
+
+    def frame(self, step):
+        """
+        frame returns the grid of a step as a 2d list, the same as ``data``
+
+        :param step: iteration
+        :type step: int
+        """
+        # the keys of data are strings after a json round trip
+        grid = self.data.get(step, self.data.get(str(step)))
+        if grid is not None or self.history == "full":
+            return grid
+
+        if self.history == "delta":
+            return self._lattice_to_2d_array(
+                self.delta_history.frame(step), self.width, self.height
+                )
+
+        return self._lattice_to_2d_array(
+            self.trajectory.frame(step), self.width, self.height
+            )
+
+    def grid(self, step = None):
+        """
+        grid returns the grid of a step as an array of races with shape
+        (width, height), unlike :meth:`frame` which returns the 2d list
+        of the heatmap. The array may be shared with the model or the
+        history and should not be changed.
+
+        :param step: iteration, the current one if None
+        :type step: int
+        :return: the grid, None if the step was not recorded
+        :rtype: numpy.ndarray
+        """
+        if step is None or step == self.current_iteration:
+            return self._current_lattice()
+
+        if self.history == "delta" and self.delta_history is not None \
+                and step <= self.delta_history.last_step:
+            return self.delta_history.frame(step)
+        if self.history == "mmap" and self.trajectory is not None \
+                and step < self.trajectory.n_frames:
+            return self.trajectory.frame(step)
+
+        grid = self.data.get(step, self.data.get(str(step)))
+        if grid is None:
+            return None
+        if self.width != self.height:
+            raise Exception(
+                "The 2d lists of data only hold square grids, "
+                "use the delta or mmap history"
+                )
+
+        return np.array(grid, dtype=np.int8)
+
+    def _snapshot(self):
+        """
+        _snapshot returns the current grid as a 2d list
+        """
+        if self.engine == "numpy":
+            return self._lattice_to_2d_array(self.lattice, self.width, self.height)
+
+        return self._agents_dict_to_2d_array(self.agents, self.width, self.height)
 
     def _is_unsatisfied(self, x, y):
         """
         is_unsatisfied calculate the satisfactory index of each agent based on
-         current neighbours.
+         current neighbours, the occupied houses of its neighbourhood.
 
         :param x: horizental coordinate, starts with 0
         :type x: int
@@ -215,85 +1240,583 @@ class Schelling():
         :return: boolean value of wether the agent is not satisfied
         :rtype: [type]
         """
+        if self.engine == "numpy":
+            count_all = int(self._occupied_counts[x, y])
+            if count_all == 0:
+                return False, 0.0
+            similarity = float(self._similar_counts[x, y])/count_all
+            return similarity < self.neighbour_similarity, similarity
+
         race = self.agents.get((x,y))
         count_similar = 0
-        count_different = 0
-
-        if x > 0 and y > 0 and (x-1, y-1) not in self.empty_houses:
-            if self.agents[(x-1, y-1)] == race:
-                count_similar += 1
-            else:
-                count_different += 1
-        if y > 0 and (x,y-1) not in self.empty_houses:
-            if self.agents[(x,y-1)] == race:
-                count_similar += 1
-            else:
-                count_different += 1
-        if x < (self.width-1) and y > 0 and (x+1,y-1) not in self.empty_houses:
-            if self.agents[(x+1,y-1)] == race:
-                count_similar += 1
-            else:
-                count_different += 1
-        if x > 0 and (x-1,y) not in self.empty_houses:
-            if self.agents[(x-1,y)] == race:
+        count_all = 0
+        for house in self.neighbourhood.houses(x, y):
+            neighbour_race = self.agents.get(house)
+            if neighbour_race is None:
+                continue
+            count_all += 1
+            if neighbour_race == race:
                 count_similar += 1
-            else:
-                count_different += 1
-        if x < (self.width-1) and (x+1,y) not in self.empty_houses:
-            if self.agents[(x+1,y)] == race:
-                count_similar += 1
-            else:
-                count_different += 1
-        if x > 0 and y < (self.height-1) and (x-1,y+1) not in self.empty_houses:
-            if self.agents[(x-1,y+1)] == race:
-                count_similar += 1
-            else:
-                count_different += 1
-        if x > 0 and y < (self.height-1) and (x,y+1) not in self.empty_houses:
-            if self.agents[(x,y+1)] == race:
-                count_similar += 1
-            else:
-                count_different += 1
-        if x < (self.width-1) and y < (self.height-1) and (x+1,y+1) not in self.empty_houses:
-            if self.agents[(x+1,y+1)] == race:
-                count_similar += 1
-            else:
-                count_different += 1
 
-        if (count_similar+count_different) == 0:
+        if count_all == 0:
             return False, 0.0
         else:
-            return float(count_similar)/(count_similar+count_different) < self.neighbour_similarity, float(count_similar)/(count_similar+count_different)
+            return float(count_similar)/count_all < self.neighbour_similarity, float(count_similar)/count_all
 
     def evove_one(self):
 
+        self._step_moves = []
+        if self.update == "synchronous":
+            return self._evolve_one_synchronous()
+        if self.schedule == "frontier":
+            return self._evolve_one_frontier()
+        if self.engine == "numpy":
+            return self._evolve_one_numpy()
+
+        profiler = StepProfiler(self.profile)
         self.current_iteration += 1
-        self.prev_agents = copy.deepcopy(self.agents)
+        # keys and races are immutable, a shallow copy is enough
+        self.prev_agents = dict(self.agents)
+        profiler.lap("prepare")
         n_changes = 0
         for agent in self.prev_agents:
             agent_is_satisfied, _ = self._is_unsatisfied(agent[0], agent[1])
             if agent_is_satisfied:
+                profiler.lap("scan")
                 agent_race = self.agents[agent]
-                empty_house = random.choice(self.empty_houses)
+                empty_house = self._choose_house(agent, agent_race)
                 self.agents[empty_house] = agent_race
                 del self.agents[agent]
                 self.empty_houses.remove(empty_house)
                 self.empty_houses.append(agent)
+                self._step_moves.append((agent, empty_house, agent_race))
                 n_changes += 1
-        self.changes.append(n_changes)
+                profiler.lap("moves")
+        profiler.lap("scan")
+        return self._record_step(n_changes, profiler, len(self.prev_agents))
+
+    def _zobrist(self):
+        """
+        _zobrist returns the table of random 64 bit keys of each house and
+        race. The keys only depend on the size of the grid and the number
+        of races, so the hashes of two models can be compared.
+
+        :return: array with shape (width * height, races)
+        :rtype: numpy.ndarray
+        """
+        if self._zobrist_table is None:
+            rng = np.random.default_rng([self.width, self.height, self.races])
+            self._zobrist_table = rng.integers(
+                0, np.iinfo(np.uint64).max, size=(self.width * self.height, self.races),
+                dtype=np.uint64, endpoint=True
+                )
+
+        return self._zobrist_table
+
+    def _lattice_hash(self, lattice):
+        """
+        _lattice_hash is the Zobrist hash of the grid: the xor of the keys
+        of the race of every occupied house
+
+        :param lattice: array of races with shape (width, height)
+        :type lattice: numpy.ndarray
+        :rtype: int
+        """
+        races = np.asarray(lattice).ravel()
+        houses = np.flatnonzero(races)
+
+        return int(np.bitwise_xor.reduce(
+            self._zobrist()[houses, races[houses] - 1], initial=np.uint64(0)
+            ))
+
+    def _moves_hash(self, moves):
+        """
+        _moves_hash is the change of the Zobrist hash made by the moves:
+        each move removes the key of the race at the old house and adds
+        the one at the new house
+        """
+        if not moves:
+            return 0
+        moves = np.array(
+            [(a[0] * self.height + a[1], b[0] * self.height + b[1], race) for a, b, race in moves],
+            dtype=np.int64
+            )
+        keys = self._zobrist()
+        races = moves[:, 2] - 1
+
+        return int(
+            np.bitwise_xor.reduce(keys[moves[:, 0], races])
+            ^ np.bitwise_xor.reduce(keys[moves[:, 1], races])
+            )
+
+    def _add_lattice_hash(self, lattice_hash):
+        """
+        _add_lattice_hash saves the hash of the current iteration and
+        remembers the earlier iteration with the same grid, if any
+        """
+        self._revisited = self._hash_iterations.get(lattice_hash)
+        self._hash_iterations.setdefault(lattice_hash, self.current_iteration)
+        self.lattice_hashes.append(lattice_hash)
+
+    def _write_trajectory_metadata(self):
+        """
+        _write_trajectory_metadata saves the parameters of the model in the
+        sidecar of the trajectory file, the series are saved with the frames
+        """
+        self.trajectory.write_metadata(
+            races=self.races,
+            empty_house_rate=self.empty_house_rate,
+            neighbour_similarity=self.neighbour_similarity
+            )
+
+    def _choose_house(self, agent, race):
+        """
+        _choose_house picks the empty house the unsatisfied agent moves to,
+        following the relocation policy of the model
+
+        :param agent: coordinates of the agent
+        :type agent: tuple
+        :param race: race of the agent
+        :type race: int
+        :return: coordinates of the empty house
+        :rtype: tuple
+        """
+        if self.relocation == "random":
+            return self.rng.choice(self.empty_houses)
+
+        if self.relocation == "nearest":
+            # the nearest houses are sorted by distance
+            for house in self.empty_houses.nearest(agent, self.relocation_k):
+                if self._relocation_score(house, race, agent)[0]:
+                    return house
+            # a random house, so the agents that can not be satisfied
+            # nearby do not keep moving between the same houses
+            return self.rng.choice(self.empty_houses)
+
+        best_house, best_score = None, None
+        for _ in range(self.relocation_k):
+            house = self.rng.choice(self.empty_houses)
+            score = self._relocation_score(house, race, agent)
+            if best_score is None or score > best_score:
+                best_house, best_score = house, score
+
+        return best_house
+
+    def _relocation_score(self, house, race, agent):
+        """
+        _relocation_score tells if an agent of the race would be satisfied
+        in the empty house and its fraction of similar neighbours there,
+        counting the neighbours the same way as :meth:`_is_unsatisfied`
+
+        :param house: coordinates of the empty house
+        :param race: race of the agent
+        :param agent: current house of the agent, which would be empty
+        :return: whether the agent is satisfied, and the similarity
+        :rtype: tuple
+        """
+        x, y = house
+        if not self.neighbourhood.small and self.engine == "numpy":
+            # too many neighbours to look at one by one
+            neighbours = self.neighbourhood.neighbours(x * self.height + y)
+            races = self.lattice.ravel()[neighbours]
+            count_all = int(np.count_nonzero(races))
+            count_similar = int(np.count_nonzero(races == race))
+            if (neighbours == agent[0] * self.height + agent[1]).any():
+                count_all -= 1
+                count_similar -= 1
+        else:
+            count_similar = 0
+            count_all = 0
+            for neighbour in self.neighbourhood.houses(x, y):
+                if neighbour == agent:
+                    continue
+                neighbour_race = self.agents.get(neighbour)
+                if neighbour_race is None:
+                    continue
+                count_all += 1
+                if neighbour_race == race:
+                    count_similar += 1
+
+        if count_all == 0:
+            return True, 0.0
+        similarity = count_similar / count_all
+
+        return similarity >= self.neighbour_similarity, similarity
+
+    def _record_step(self, n_changes, profiler, n_evaluated):
+        """
+        _record_step saves the number of changes, the grid and the order
+        parameter of the current iteration
+
+        What is saved depends on the record level of :meth:`iter_evolve`.
+        Steps are saved in ``data`` when the delta or mmap history is
+        missing the previous steps, so :meth:`frame` still finds them.
+
+        If profiling is on, the profile of the step is appended to
+        ``profiles``: the seconds spent in each phase, ``prepare``
+        (copying the agents or computing which agents are unsatisfied),
+        ``scan`` (evaluating the agents), ``moves`` (picking the empty houses
+        and moving the agents), ``history`` and ``order_parameter``, and the
+        number of agents ``evaluated``, of ``moves`` and of ``vacancies``
+        the empty houses were picked from.
+
+        :param n_changes: number of agents moved
+        :param profiler: profiler of the step
+        :type profiler: StepProfiler
+        :param n_evaluated: number of agents evaluated
+        :return: record of the step, see :meth:`iter_evolve`
+        :rtype: dict
+        """
+        record = self._record
         logger.debug("changes: {}".format(n_changes))
-        self.data[self.current_iteration] = self._agents_dict_to_2d_array(
-            self.agents, self.width, self.height
+        if record != "none":
+            self.changes.append(n_changes)
+        if self.cycle_detection:
+            if self.lattice_hashes:
+                lattice_hash = self.lattice_hashes[-1] ^ self._moves_hash(self._step_moves)
+            else:
+                lattice_hash = self._lattice_hash(self._current_lattice())
+            self._add_lattice_hash(lattice_hash)
+
+        saved_to_file = False
+        if record == "full":
+            if (
+                self.history == "delta"
+                and self.delta_history.last_step == self.current_iteration - 1
+            ):
+                self.delta_history.append(self._step_moves, self._current_lattice())
+            elif (
+                self.history == "mmap"
+                and self.trajectory.n_frames == self.current_iteration
+            ):
+                saved_to_file = True
+            else:
+                self.data[self.current_iteration] = self._snapshot()
+        elif record == "keyframes" and self.current_iteration % self.keyframe_interval == 0:
+            self.data[self.current_iteration] = self._snapshot()
+        profiler.lap("history")
+
+        order_parameter = self._order_parameter()
+        if record != "none":
+            self.order_parameters.append(order_parameter)
+        profiler.lap("order_parameter")
+        if saved_to_file:
+            self.trajectory.append(
+                self._current_lattice(), changes=n_changes,
+                order_parameters=order_parameter
+                )
+            self._write_trajectory_metadata()
+            profiler.lap("history")
+
+        if profiler.enabled:
+            profile = {
+                "iteration": self.current_iteration,
+                "evaluated": n_evaluated,
+                "moves": n_changes,
+                "vacancies": len(self.empty_houses)
+            }
+            profile["seconds"] = {
+                phase: profiler.phases.get(phase, 0.0)
+                for phase in ("prepare", "scan", "moves", "history", "order_parameter")
+                }
+            self.profiles.append(profile)
+
+        return {
+            "iteration": self.current_iteration,
+            "changes": n_changes,
+            "order_parameter": order_parameter
+        }
+
+    def _evolve_one_numpy(self):
+        """
+        _evolve_one_numpy is :meth:`evove_one` for the numpy engine.
+
+        The satisfaction of the whole grid is computed at once from the
+        neighbour counts, which are kept up to date on every move. Agents are
+        still visited one by one in the order of ``self.agents`` so that the
+        moves are the same as the dict engine. Only the agents around a move
+        are evaluated again.
+        """
+
+        profiler = StepProfiler(self.profile)
+        self.current_iteration += 1
+        unhappy = set(
+            map(tuple, np.argwhere(self._unsatisfied_mask()).tolist())
+            )
+        touched = set()
+        agents = list(self.agents)
+        profiler.lap("prepare")
+        n_changes = 0
+        for agent in agents:
+            if agent[0] * self.height + agent[1] in touched:
+                agent_is_satisfied, _ = self._is_unsatisfied(agent[0], agent[1])
+            else:
+                agent_is_satisfied = agent in unhappy
+            if agent_is_satisfied:
+                profiler.lap("scan")
+                empty_house = self._choose_house(agent, self.agents[agent])
+                self._move_agent(agent, empty_house)
+                touched.update(self._window_houses(*agent))
+                touched.update(self._window_houses(*empty_house))
+                n_changes += 1
+                profiler.lap("moves")
+        profiler.lap("scan")
+        return self._record_step(n_changes, profiler, len(agents))
+
+    def _evolve_one_frontier(self):
+        """
+        _evolve_one_frontier is :meth:`evove_one` with the frontier schedule.
+
+        Only agents in the frontier are evaluated. They are visited in the
+        order of ``self.agents`` using their ranks, so the moves are the same
+        as with the full schedule. When an agent moves, the agents around the
+        two houses are evaluated later in this step if their turn has not
+        come yet, otherwise they join the frontier of the next step.
+        Agents that moved in this step are evaluated in the next step,
+        like in the dict engine.
+        """
+
+        profiler = StepProfiler(self.profile)
+        self.current_iteration += 1
+        first_new_rank = self._next_rank
+        queue = [
+            (int(self._rank[house]), house) for house in self._frontier
+            if self._rank[house] >= 0
+            ]
+        heapq.heapify(queue)
+        queued = set(self._frontier)
+        self._frontier = set()
+        profiler.lap("prepare")
+        n_changes = 0
+        n_evaluated = 0
+        while queue:
+            rank, agent = heapq.heappop(queue)
+            # the agent has moved away since it was queued
+            if self._rank[agent] != rank:
+                continue
+            n_evaluated += 1
+            agent_is_satisfied, _ = self._is_unsatisfied(agent[0], agent[1])
+            if not agent_is_satisfied:
+                continue
+            profiler.lap("scan")
+            empty_house = self._choose_house(agent, self.agents[agent])
+            self._move_agent(agent, empty_house)
+            n_changes += 1
+            for x, y in (agent, empty_house):
+                houses = self._window_houses(x, y)
+                ranks = self._rank.ravel().take(houses).tolist()
+                for house, house_rank in zip(houses, ranks):
+                    if house_rank < 0:
+                        continue
+                    house = divmod(house, self.height)
+                    if rank < house_rank < first_new_rank:
+                        if house not in queued:
+                            queued.add(house)
+                            heapq.heappush(queue, (house_rank, house))
+                    else:
+                        self._frontier.add(house)
+            profiler.lap("moves")
+        profiler.lap("scan")
+        return self._record_step(n_changes, profiler, n_evaluated)
+
+    def _evolve_one_synchronous(self):
+        """
+        _evolve_one_synchronous is :meth:`evove_one` with the synchronous
+        update.
+
+        All the agents are evaluated on the grid at the start of the step
+        and every unsatisfied agent picks a random empty house. When several
+        agents pick the same house, the one with the highest random priority
+        moves there and the others stay. The houses left by the agents only
+        become free at the next step. The neighbour counts of the whole
+        grid are then computed again.
+        """
+        profiler = StepProfiler(self.profile)
+        self.current_iteration += 1
+        # the mask is also True for some empty houses
+        movers = np.flatnonzero(self._unsatisfied_mask() & (self.lattice > 0))
+        vacancies = self.empty_houses.flat()
+        profiler.lap("prepare")
+
+        if len(movers) == 0 or len(vacancies) == 0:
+            profiler.lap("scan")
+            return self._record_step(0, profiler, len(self.agents))
+
+        # numpy generator seeded from the generator of the model,
+        # so the state saved by model_state is enough to continue
+        rng = np.random.default_rng(self.rng.getrandbits(64))
+        targets = vacancies[rng.integers(len(vacancies), size=len(movers))]
+        order = rng.permutation(len(movers))
+        # the first agent of each house in the random order moves
+        _, first = np.unique(targets[order], return_index=True)
+        winners = order[first]
+        origins, houses = movers[winners], targets[winners]
+        profiler.lap("scan")
+
+        origin_x, origin_y = np.divmod(origins, self.height)
+        house_x, house_y = np.divmod(houses, self.height)
+        races = self.lattice[origin_x, origin_y]
+        self.lattice[origin_x, origin_y] = 0
+        self.lattice[house_x, house_y] = races
+        self._rank[origin_x, origin_y] = -1
+        self._rank[house_x, house_y] = np.arange(
+            self._next_rank, self._next_rank + len(houses)
+            )
+        self._next_rank += len(houses)
+        self.empty_houses = VacancyIndex.from_flat(
+            self.width, self.height,
+            np.concatenate([vacancies[~np.isin(vacancies, houses)], origins])
             )
-        self.order_parameters.append(
-            self._order_parameter()
-        )
+
+        self._step_moves = list(zip(
+            zip(origin_x.tolist(), origin_y.tolist()),
+            zip(house_x.tolist(), house_y.tolist()),
+            races.tolist()
+            ))
+        for agent, house, race in self._step_moves:
+            del self.agents[agent]
+            self.agents[house] = race
+        profiler.lap("moves")
+
+        self._count_neighbours()
+        profiler.lap("scan")
+
+        return self._record_step(len(houses), profiler, len(self.agents))
+
+    def _unsatisfied_mask(self):
+        """
+        _unsatisfied_mask is the vectorized :meth:`_is_unsatisfied` of the
+        numpy engine
+
+        :return: boolean array which is True for unsatisfied agents
+        :rtype: numpy.ndarray
+        """
+        if self._shared is not None:
+            return self._shared.unsatisfied_mask(self.neighbour_similarity)
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            similarity = self._similar_counts / self._occupied_counts
+
+        return (self._occupied_counts > 0) & (similarity < self.neighbour_similarity)
+
+    def _window_houses(self, x, y):
+        """
+        _window_houses lists the flat indices of the house (x, y) and of its
+        neighbours
+        """
+        flat = x * self.height + y
+        return [flat] + self.neighbourhood.neighbours(flat).tolist()
+
+    def _move_agent(self, agent, empty_house):
+        """
+        _move_agent moves the agent to the empty house and updates the
+        lattice and the neighbour counts of the numpy engine
+
+        :param agent: coordinates of the agent
+        :type agent: tuple
+        :param empty_house: coordinates of the empty house
+        :type empty_house: tuple
+        """
+        agent_race = self.agents[agent]
+        self.agents[empty_house] = agent_race
+        del self.agents[agent]
+        self.empty_houses.remove(empty_house)
+        self.empty_houses.append(agent)
+        self._step_moves.append((agent, empty_house, agent_race))
+
+        self._update_house(agent[0], agent[1], 0)
+        self._update_house(empty_house[0], empty_house[1], agent_race)
+        self._rank[agent] = -1
+        self._rank[empty_house] = self._next_rank
+        self._next_rank += 1
+
+    def _update_house(self, x, y, race):
+        """
+        _update_house moves an agent of the race into the empty house (x, y),
+        or empties the house if race is 0.
+
+        Only the neighbour counts and similarities of the neighbours of the
+        house change, so the counts and the running sum of the order
+        parameter are updated on the neighbours only.
+
+        :param x: horizental coordinate, starts with 0
+        :type x: int
+        :param y: vertical coordinate, starts with 0
+        :type y: int
+        :param race: race of the new agent, 0 for an empty house
+        :type race: int
+        """
+        flat = x * self.height + y
+        neighbours = self.neighbourhood.neighbours(flat)
+        # flat views of the arrays
+        lattice = self.lattice.ravel()
+        occupied_counts = self._occupied_counts.ravel()
+        similar_counts = self._similar_counts.ravel()
+
+        count_center = int(occupied_counts[flat])
+        similarity_sum = self._similarity_sum
+        if race:
+            delta = 1
+        else:
+            delta, race = -1, int(lattice[flat])
+            if count_center:
+                similarity_sum -= int(similar_counts[flat]) / count_center
+
+        # a few neighbours are faster to update on python lists
+        races = lattice.take(neighbours).tolist()
+        counts_all = occupied_counts.take(neighbours).tolist()
+        counts_similar = similar_counts.take(neighbours).tolist()
+        similar_center = 0
+        for i, neighbour_race in enumerate(races):
+            count_all = counts_all[i]
+            counts_all[i] = count_all + delta
+            if not neighbour_race:
+                continue
+            count_similar = counts_similar[i]
+            if neighbour_race == race:
+                similar_center += 1
+                counts_similar[i] = count_similar + delta
+            # replace the similarity of the neighbour in the running sum
+            if count_all:
+                similarity_sum -= count_similar / count_all
+            if count_all + delta:
+                similarity_sum += counts_similar[i] / (count_all + delta)
+        occupied_counts.put(neighbours, counts_all)
+        similar_counts.put(neighbours, counts_similar)
+
+        if delta > 0:
+            similar_counts[flat] = similar_center
+            if count_center:
+                similarity_sum += similar_center / count_center
+            lattice[flat] = race
+        else:
+            similar_counts[flat] = 0
+            lattice[flat] = 0
+        self._similarity_sum = similarity_sum
+
+    def _similarities(self):
+        """
+        _similarities is the fraction of similar neighbours of each agent of
+        the numpy engine, 0 for empty houses and agents without neighbours
+
+        :rtype: numpy.ndarray
+        """
+        similarity = self._similar_counts / np.maximum(self._occupied_counts, 1)
+
+        return np.where(self.lattice > 0, similarity, 0.0)
 
     def _order_parameter(self):
         """
-        order_parameter calculates the
+        order_parameter calculates the average fraction of similar
+        neighbours of the agents.
+
+        The numpy engine keeps a running sum of the fractions,
+        so this is a lookup instead of a scan of all the agents.
         """
 
+        if self.engine == "numpy":
+            return float(self._similarity_sum)/len(self.agents)
+
         order_param = 0
         for agent in self.agents:
             agent_is_satisfied, agent_neighbour_similarity = self._is_unsatisfied(agent[0], agent[1])
@@ -301,17 +1824,124 @@ class Schelling():
 
         return order_param/len(self.agents)
 
-    def evolve(self):
+    def close(self):
+        """
+        close stops the processes of the parallel mode and flushes the
+        trajectory file. The model keeps working on a copy of the grid
+        in the main process.
+        """
+        if self.trajectory is not None:
+            self.trajectory.flush()
+        if self._shared is None:
+            return
+        self.lattice = self.lattice.copy()
+        self._occupied_counts = self._occupied_counts.copy()
+        self._similar_counts = self._similar_counts.copy()
+        self.workers = 1
+        shared, self._shared = self._shared, None
+        shared.close()
+
+    def iter_evolve(self, n_steps = None, record = None, moves = False):
+        """
+        iter_evolve evolves the model one step at a time until no agent
+        moves, and yields a record of each step as a dict with the
+        ``iteration``, the number of ``changes`` and the ``order_parameter``.
+
+        It also stops when the grid is the same as at an earlier step
+        (``cycle_detection``) or when the order parameter and the changes
+        do not vary any more (``plateau_window``). The reason is saved in
+        ``stop_reason`` and added to the record of the last step:
+        ``"equilibrium"``, ``"cycle"``, ``"plateau"`` or ``"n_iterations"``
+        when all the steps are done.
+
+        The record level chooses what the model keeps of each step:
+
+        - ``"none"``: nothing, the records are the only output,
+        - ``"stats"``: ``changes`` and ``order_parameters``,
+        - ``"keyframes"``: the stats and the grid every
+          ``keyframe_interval`` steps in ``data``,
+        - ``"full"``: the stats and the grid of every step in the history
+          of the model.
+
+        :param n_steps: maximum number of steps, n_iterations if None
+        :type n_steps: int
+        :param record: record level, ``"full"`` if None
+        :type record: str
+        :param moves: add the list of ``moves`` of the step to the records,
+            as tuples of the old house, the new house and the race
+        :type moves: bool
+        """
+        if record is None:
+            record = "full"
+        if record not in RECORD_LEVELS:
+            raise Exception("No record {} found".format(record))
+
+        self._record = record
+        self.stop_reason = None
+        if self.plateau_window:
+            recent = collections.deque(maxlen=self.plateau_window)
+        else:
+            recent = None
+        try:
+            n_steps = n_steps or self.n_iterations
+            for i in range(n_steps):
+                step = self.evove_one()
+                if moves:
+                    step["moves"] = list(self._step_moves)
+                self.stop_reason = self._stop_reason(step, recent)
+                if self.stop_reason is None and i == n_steps - 1:
+                    self.stop_reason = "n_iterations"
+                if self.stop_reason is not None:
+                    step["stop_reason"] = self.stop_reason
+                yield step
+                if self.stop_reason is not None:
+                    break
+        finally:
+            self._record = "full"
+
+    def _stop_reason(self, step, recent = None):
+        """
+        _stop_reason tells why the evolution should stop after the step,
+        or None if it should go on
+
+        :param step: record of the step
+        :type step: dict
+        :param recent: changes and order parameters of the latest steps,
+            for the plateau detection
+        :type recent: collections.deque
+        """
+        # check if we have reached equlibrium
+        if step["changes"] == 0:
+            return "equilibrium"
+        if self.cycle_detection and self._revisited is not None:
+            logger.info("iteration {} has the grid of iteration {}".format(
+                step["iteration"], self._revisited
+                ))
+            return "cycle"
+        if recent is not None:
+            recent.append((step["changes"], step["order_parameter"]))
+            if len(recent) == recent.maxlen:
+                half = len(recent) // 2
+                first = np.mean(list(recent)[:half], axis=0)
+                second = np.mean(list(recent)[-half:], axis=0)
+                if (
+                    abs(second[1] - first[1]) <= self.plateau_tolerance
+                    and abs(second[0] - first[0])
+                    <= self.plateau_changes_tolerance * max(first[0], second[0])
+                ):
+                    return "plateau"
+
+        return None
+
+    def evolve(self, record = None):
         """
         evolve calculates the predefined number of steps
+
+        :param record: record level, see :meth:`iter_evolve`
         """
 
-        for i in range(self.n_iterations):
-            self.evove_one()
-            # check if we have reached equlibrium
-            # not the best way but kind of works
-            if self.changes[-1] == 0:
-                break
+        for _ in self.iter_evolve(record=record):
+            pass
 
 
 if __name__ == "__main__":
@@ -0,0 +1,253 @@
+import collections
+import contextlib
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import weakref
+
+from models import Schelling
+
+logging.basicConfig()
+logger = logging.getLogger('store')
+logger.setLevel(logging.WARNING)
+
+
+class MemoryStore():
+    """
+    MemoryStore keeps live models in the memory of the process.
+
+    Sessions that were not used for ``ttl`` seconds expire, and the least
+    recently used sessions are dropped when there are more than
+    ``max_sessions``. It is not shared between gunicorn workers.
+
+    :param max_sessions: maximum number of sessions to keep
+    :param ttl: seconds after which an unused session expires
+    """
+    def __init__(self, max_sessions = None, ttl = None):
+
+        self.max_sessions = max_sessions or 100
+        self.ttl = ttl or 3600
+        self._sessions = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, session_id):
+        """
+        get returns the model of the session, or None if there is none
+
+        :param session_id: id of the session
+        :type session_id: str
+        :rtype: Schelling
+        """
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None:
+                return None
+            accessed, model = session
+            if time.time() - accessed > self.ttl:
+                del self._sessions[session_id]
+                return None
+            self._sessions[session_id] = (time.time(), model)
+            self._sessions.move_to_end(session_id)
+            return model
+
+    def set(self, session_id, model):
+        """
+        set saves the model of the session
+
+        :param session_id: id of the session
+        :type session_id: str
+        :param model: the model
+        :type model: Schelling
+        """
+        with self._lock:
+            self._sessions[session_id] = (time.time(), model)
+            self._sessions.move_to_end(session_id)
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+
+    def delete(self, session_id):
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+
+class SQLiteStore():
+    """
+    SQLiteStore saves the model states in a sqlite file so that all the
+    gunicorn workers on the machine can share the sessions.
+
+    Each worker also keeps the live models it has loaded. A model is only
+    loaded from the file again when another worker has saved a newer
+    version of it.
+
+    :param path: path of the sqlite file
+    :param max_sessions: maximum number of sessions to keep
+    :param ttl: seconds after which an unused session expires
+    :param max_live_models: number of live models kept by each worker
+    """
+    def __init__(self, path, max_sessions = None, ttl = None, max_live_models = None):
+
+        self.path = path
+        self.max_sessions = max_sessions or 1000
+        self.ttl = ttl or 3600
+        self.max_live_models = max_live_models or 32
+        # session id: (version, model)
+        self._models = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS sessions ("
+                "session_id TEXT PRIMARY KEY, version INTEGER, "
+                "accessed REAL, state TEXT)"
+                )
+
+    @contextlib.contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def _cache_model(self, session_id, version, model):
+        with self._lock:
+            self._models[session_id] = (version, model)
+            self._models.move_to_end(session_id)
+            while len(self._models) > self.max_live_models:
+                self._models.popitem(last=False)
+
+    def get(self, session_id):
+        """
+        get returns the model of the session, or None if there is none
+
+        :param session_id: id of the session
+        :type session_id: str
+        :rtype: Schelling
+        """
+        now = time.time()
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT version, accessed FROM sessions WHERE session_id = ?",
+                (session_id,)
+                ).fetchone()
+            if row is None:
+                return None
+            version, accessed = row
+            if now - accessed > self.ttl:
+                conn.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+                return None
+            # avoid writing on every read
+            if now - accessed > 60:
+                conn.execute(
+                    "UPDATE sessions SET accessed = ? WHERE session_id = ?",
+                    (now, session_id)
+                    )
+
+            cached = self._models.get(session_id)
+            if cached is not None and cached[0] == version:
+                return cached[1]
+
+            logger.debug("loading session {} version {}".format(session_id, version))
+            state, = conn.execute(
+                "SELECT state FROM sessions WHERE session_id = ?", (session_id,)
+                ).fetchone()
+
+        model = Schelling(json.loads(state))
+        self._cache_model(session_id, version, model)
+
+        return model
+
+    def set(self, session_id, model):
+        """
+        set saves the model of the session
+
+        :param session_id: id of the session
+        :type session_id: str
+        :param model: the model
+        :type model: Schelling
+        """
+        now = time.time()
+        state = json.dumps(model.model_state(compact=True))
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT version FROM sessions WHERE session_id = ?", (session_id,)
+                ).fetchone()
+            version = (row[0] if row else 0) + 1
+            conn.execute(
+                "INSERT OR REPLACE INTO sessions "
+                "(session_id, version, accessed, state) VALUES (?, ?, ?, ?)",
+                (session_id, version, now, state)
+                )
+            conn.execute("DELETE FROM sessions WHERE accessed < ?", (now - self.ttl,))
+            conn.execute(
+                "DELETE FROM sessions WHERE session_id NOT IN "
+                "(SELECT session_id FROM sessions ORDER BY accessed DESC LIMIT ?)",
+                (self.max_sessions,)
+                )
+        self._cache_model(session_id, version, model)
+
+    def delete(self, session_id):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+        with self._lock:
+            self._models.pop(session_id, None)
+
+
+class SessionLocks():
+    """
+    SessionLocks hands out a lock per session, so that the requests and
+    the jobs of a session do not change or read its model at the same
+    time. The locks are reentrant and only live while they are used.
+
+    The locks are local to the process, the stores that are shared
+    between gunicorn workers give each worker its own live models.
+    """
+    def __init__(self):
+
+        self._locks = weakref.WeakValueDictionary()
+        self._lock = threading.Lock()
+
+    def __call__(self, session_id):
+        """
+        returns the lock of the session
+
+        :param session_id: id of the session
+        :type session_id: str
+        :rtype: threading.RLock
+        """
+        with self._lock:
+            lock = self._locks.get(session_id)
+            if lock is None:
+                lock = threading.RLock()
+                self._locks[session_id] = lock
+            return lock
+
+
+def make_store(url = None):
+    """
+    make_store creates the session store from a url
+
+    ``memory`` keeps the models in the process and ``sqlite:///path/to.db``
+    saves them in a sqlite file. The url is read from the environment
+    variable ``SCHELLING_SESSION_STORE`` if it is not given, and defaults to
+    a sqlite file in the temporary directory.
+
+    :param url: url of the store
+    :type url: str
+    """
+    if url is None:
+        url = os.environ.get("SCHELLING_SESSION_STORE")
+    if url is None:
+        url = "sqlite:///" + os.path.join(tempfile.gettempdir(), "schelling-sessions.db")
+
+    if url == "memory":
+        return MemoryStore()
+    elif url.startswith("sqlite:///"):
+        return SQLiteStore(url[len("sqlite:///"):])
+    else:
+        raise Exception("No session store {} found".format(url))
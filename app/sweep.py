@@ -0,0 +1,204 @@
+"""
+Parameter sweeps of the Schelling model.
+
+Each cell of the grid of parameters is run a number of times with different
+seeds on a process pool. The summary of each run is appended to a csv file
+as soon as it is done, and runs already in the file are skipped, so an
+interrupted sweep can be started again with the same command::
+
+    python app/sweep.py --similarity 0.3 0.5 0.7 --empty-house-rate 0.1 0.2 \\
+        --races 2 3 --size 50 100 --replicates 5 --output sweep.csv
+"""
+import argparse
+import concurrent.futures
+import csv
+import hashlib
+import itertools
+import json
+import logging
+import os
+import time
+
+from models import Schelling
+
+logging.basicConfig()
+logger = logging.getLogger('sweep')
+logger.setLevel(logging.INFO)
+
+PARAMETERS = ["neighbour_similarity", "empty_house_rate", "races", "size", "replicate"]
+COLUMNS = PARAMETERS + [
+    "seed", "iterations", "equilibrium", "stop_reason", "order_parameter", "wall_time",
+    "changes", "order_parameters"
+]
+
+
+def run_seed(base_seed, run):
+    """
+    run_seed derives the seed of a run from the base seed and the
+    parameters of the run, so that it does not depend on the order or
+    the process the runs are done in.
+
+    :param base_seed: seed of the sweep
+    :type base_seed: int
+    :param run: parameters of the run, see :data:`PARAMETERS`
+    :type run: dict
+    :rtype: int
+    """
+    key = json.dumps([base_seed] + [run[p] for p in PARAMETERS])
+    return int(hashlib.sha256(key.encode("utf-8")).hexdigest()[:16], 16)
+
+
+def run_key(run):
+    """run_key identifies a run in the csv file"""
+    return tuple(str(run[p]) for p in PARAMETERS)
+
+
+def run_model(run, seed, n_iterations, engine = None):
+    """
+    run_model runs one model to equilibrium or n_iterations
+
+    :param run: parameters of the run, see :data:`PARAMETERS`
+    :type run: dict
+    :param seed: seed of the random number generator of the model
+    :type seed: int
+    :param n_iterations: maximum number of iterations
+    :type n_iterations: int
+    :return: summary of the run, see :data:`COLUMNS`
+    :rtype: dict
+    """
+    start = time.time()
+    engine = engine or "numpy"
+    schelling_model = Schelling(
+        {
+            "width": run["size"],
+            "height": run["size"],
+            "races": run["races"],
+            "empty_house_rate": run["empty_house_rate"],
+            "neighbour_similarity": run["neighbour_similarity"],
+            "n_iterations": n_iterations,
+            # the frontier schedule only works with the numpy engine
+            "schedule": "frontier" if engine == "numpy" else "full",
+            "seed": seed
+        },
+        engine=engine
+        )
+    schelling_model.initialize()
+    # only the series are needed
+    schelling_model.evolve(record="stats")
+
+    summary = dict(run)
+    summary.update({
+        "seed": seed,
+        "iterations": schelling_model.current_iteration,
+        "equilibrium": schelling_model.stop_reason == "equilibrium",
+        "stop_reason": schelling_model.stop_reason,
+        "order_parameter": schelling_model.order_parameters[-1],
+        "wall_time": time.time() - start,
+        "changes": json.dumps(schelling_model.changes),
+        "order_parameters": json.dumps(schelling_model.order_parameters)
+    })
+
+    return summary
+
+
+def completed_runs(path):
+    """
+    completed_runs reads the keys of the runs already in the csv file
+
+    :param path: path of the csv file
+    :type path: str
+    :rtype: set
+    """
+    if not os.path.exists(path):
+        return set()
+    with open(path, newline="") as f:
+        return {run_key(row) for row in csv.DictReader(f)}
+
+
+def sweep(
+    similarities, empty_house_rates, races, sizes, replicates, output,
+    n_iterations = 100, workers = None, seed = 0, engine = None
+):
+    """
+    sweep runs the models of all the combinations of the parameters
+
+    :param similarities: values of neighbour_similarity
+    :param empty_house_rates: values of empty_house_rate
+    :param races: values of races
+    :param sizes: values of the width and height of the grid
+    :param replicates: number of runs of each combination
+    :param output: path of the csv file the results are appended to
+    :param n_iterations: maximum number of iterations of each run
+    :param workers: number of processes, the number of cpus if None
+    :param seed: seed of the sweep, see :func:`run_seed`
+    :param engine: engine of the models, numpy if None
+    :return: number of runs done. The runs that failed are logged and
+        not written, so they are done again when the sweep is resumed
+    :rtype: int
+    """
+    runs = [
+        dict(zip(PARAMETERS, values))
+        for values in itertools.product(
+            similarities, empty_house_rates, races, sizes, range(replicates)
+            )
+        ]
+    done = completed_runs(output)
+    runs = [run for run in runs if run_key(run) not in done]
+    logger.info("{} runs to do, {} already done".format(len(runs), len(done)))
+
+    write_header = not os.path.exists(output) or os.path.getsize(output) == 0
+    with open(output, "a", newline="") as f, \
+            concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        writer = csv.DictWriter(f, fieldnames=COLUMNS)
+        if write_header:
+            writer.writeheader()
+        futures = {
+            executor.submit(run_model, run, run_seed(seed, run), n_iterations, engine): run
+            for run in runs
+            }
+        n_done = 0
+        for i, future in enumerate(concurrent.futures.as_completed(futures), 1):
+            run = futures[future]
+            try:
+                summary = future.result()
+            except Exception:
+                # one failing run must not lose the results of the others
+                logger.exception("{}/{}: run {} failed".format(i, len(runs), run))
+                continue
+            writer.writerow(summary)
+            # flush every run so an interrupted sweep can be resumed
+            f.flush()
+            n_done += 1
+            logger.info("{}/{}: {}".format(
+                i, len(runs), {p: summary[p] for p in PARAMETERS}
+                ))
+
+    if n_done < len(runs):
+        logger.warning("{} of {} runs failed".format(len(runs) - n_done, len(runs)))
+
+    return n_done
+
+
+def main(args = None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("--similarity", type=float, nargs="+", default=[0.6])
+    parser.add_argument("--empty-house-rate", type=float, nargs="+", default=[0.2])
+    parser.add_argument("--races", type=int, nargs="+", default=[2])
+    parser.add_argument("--size", type=int, nargs="+", default=[20])
+    parser.add_argument("--replicates", type=int, default=1)
+    parser.add_argument("--iterations", type=int, default=100)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--engine", choices=["dict", "numpy"], default="numpy")
+    parser.add_argument("--output", default="sweep.csv")
+    args = parser.parse_args(args)
+
+    sweep(
+        args.similarity, args.empty_house_rate, args.races, args.size,
+        args.replicates, args.output, n_iterations=args.iterations,
+        workers=args.workers, seed=args.seed, engine=args.engine
+        )
+
+
+if __name__ == "__main__":
+    main()
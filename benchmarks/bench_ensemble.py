@@ -0,0 +1,125 @@
+"""
+Benchmarks of the ensembles of replicas of the Schelling model.
+
+Runs the same number of replicas as one :class:`ensemble.Ensemble` and as
+separate models with the synchronous update, one after the other, and
+reports the wall time of both and the mean final order parameter, which
+should be about the same::
+
+    python benchmarks/bench_ensemble.py --output benchmarks/results/ensemble.json
+"""
+import argparse
+import json
+import logging
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app"))
+
+from ensemble import Ensemble  # noqa: E402
+from models import Schelling  # noqa: E402
+
+logging.basicConfig()
+logger = logging.getLogger('benchmarks')
+logger.setLevel(logging.INFO)
+
+SIZES = [20, 50, 100]
+REPLICAS = [10, 100, 500]
+
+
+def run_ensemble(size, replicas, n_iterations, seed):
+    start = time.perf_counter()
+    ensemble = Ensemble(
+        {"width": size, "height": size, "n_iterations": n_iterations},
+        replicas=replicas, seed=seed
+        )
+    ensemble.initialize()
+    ensemble.evolve()
+
+    return {
+        "wall_time": time.perf_counter() - start,
+        "order_parameter": float(ensemble.order_parameters[:, -1].mean())
+    }
+
+
+def run_models(size, replicas, n_iterations, seed):
+    start = time.perf_counter()
+    order_parameters = []
+    for replica in range(replicas):
+        model = Schelling(
+            {
+                "width": size,
+                "height": size,
+                "n_iterations": n_iterations,
+                "update": "synchronous",
+                "seed": seed * replicas + replica
+            },
+            engine="numpy"
+            )
+        model.initialize()
+        model.evolve(record="stats")
+        order_parameters.append(model.order_parameters[-1])
+
+    return {
+        "wall_time": time.perf_counter() - start,
+        "order_parameter": statistics.mean(order_parameters)
+    }
+
+
+def run(sizes, replicas, n_iterations, seed = 0):
+    """
+    run times all the cases
+
+    :return: list of results, one per size and number of replicas
+    :rtype: list
+    """
+    results = []
+    for size in sizes:
+        for n_replicas in replicas:
+            ensemble = run_ensemble(size, n_replicas, n_iterations, seed)
+            models = run_models(size, n_replicas, n_iterations, seed)
+            result = {
+                "size": size,
+                "replicas": n_replicas,
+                "ensemble_wall_time": ensemble["wall_time"],
+                "models_wall_time": models["wall_time"],
+                "ensemble_order_parameter": ensemble["order_parameter"],
+                "models_order_parameter": models["order_parameter"]
+            }
+            logger.info(result)
+            results.append(result)
+
+    return results
+
+
+def main(args = None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES)
+    parser.add_argument("--replicas", type=int, nargs="+", default=REPLICAS)
+    parser.add_argument("--iterations", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="json file to save the results to")
+    args = parser.parse_args(args)
+
+    results = run(args.sizes, args.replicas, args.iterations, args.seed)
+
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, "w") as f:
+            json.dump({"results": results}, f, indent=1)
+
+    print("{:>5} {:>8} {:>10} {:>10} {:>8} {:>8} {:>8}".format(
+        "size", "replicas", "ensemble", "models", "speedup", "order", "order"
+        ))
+    for r in results:
+        print("{:>5} {:>8} {:>10.3f} {:>10.3f} {:>8.1f} {:>8.3f} {:>8.3f}".format(
+            r["size"], r["replicas"], r["ensemble_wall_time"], r["models_wall_time"],
+            r["models_wall_time"] / max(r["ensemble_wall_time"], 1e-9),
+            r["ensemble_order_parameter"], r["models_order_parameter"]
+            ))
+
+
+if __name__ == "__main__":
+    main()
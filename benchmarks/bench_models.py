@@ -0,0 +1,258 @@
+"""
+Benchmarks of the hot paths of the Schelling model.
+
+Times ``initialize``, ``evove_one``, ``_is_unsatisfied``,
+``_order_parameter``, ``_agents_dict_to_2d_array`` and the round trip of
+the state through json that the app does on every callback, for several
+grid sizes, vacancy rates, thresholds and engines::
+
+    python benchmarks/bench_models.py --output benchmarks/results/$(git rev-parse --short HEAD).json
+    python benchmarks/bench_models.py --compare benchmarks/results/<older>.json
+
+The results are saved as json with the best and mean time of each case,
+and the scaling exponent of each benchmark, the slope of log(time) against
+log(number of houses): 1 is linear in the number of houses, 2 quadratic.
+Grids of 500x500 and more are only timed once, the default cases take
+several minutes.
+"""
+import argparse
+import itertools
+import json
+import logging
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app"))
+
+from models import Schelling  # noqa: E402
+
+logging.basicConfig()
+logger = logging.getLogger('benchmarks')
+logger.setLevel(logging.INFO)
+
+SIZES = [20, 50, 100, 200, 500, 1000]
+EMPTY_HOUSE_RATES = [0.1, 0.3]
+SIMILARITIES = [0.3, 0.7]
+ENGINES = ["dict", "numpy"]
+# number of agents _is_unsatisfied is timed on
+SATISFACTION_SAMPLE = 1000
+# grids with this many houses or more are only timed once
+LARGE_GRID = 500 * 500
+
+
+def _timeit(func, repeat):
+    """_timeit returns the times of repeat calls of func in seconds"""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+
+    return times
+
+
+def _model(size, empty_house_rate, neighbour_similarity, engine, seed):
+    return Schelling(
+        {
+            "width": size,
+            "height": size,
+            "empty_house_rate": empty_house_rate,
+            "neighbour_similarity": neighbour_similarity,
+            "seed": seed
+        },
+        engine=engine
+        )
+
+
+def bench_case(size, empty_house_rate, neighbour_similarity, engine, repeat, seed = 0):
+    """
+    bench_case times all the benchmarks on one model
+
+    :return: dict of benchmark name: list of times in seconds
+    :rtype: dict
+    """
+    times = {}
+
+    models = []
+
+    def initialize():
+        model = _model(size, empty_house_rate, neighbour_similarity, engine, seed)
+        model.initialize()
+        models.append(model)
+
+    times["initialize"] = _timeit(initialize, repeat)
+    model = models[-1]
+
+    agents = list(model.agents)[:SATISFACTION_SAMPLE]
+
+    def is_unsatisfied():
+        for x, y in agents:
+            model._is_unsatisfied(x, y)
+
+    # per call
+    times["_is_unsatisfied"] = [
+        t / len(agents) for t in _timeit(is_unsatisfied, repeat)
+        ]
+    times["_order_parameter"] = _timeit(model._order_parameter, repeat)
+    times["_agents_dict_to_2d_array"] = _timeit(
+        lambda: model._agents_dict_to_2d_array(model.agents, model.width, model.height),
+        repeat
+        )
+
+    # the first steps move the most agents
+    times["evove_one"] = _timeit(model.evove_one, repeat)
+
+    for compact in (False, True):
+        name = "model_state_json" + ("_compact" if compact else "")
+        times[name] = _timeit(
+            lambda: Schelling(json.loads(json.dumps(model.model_state(compact=compact)))),
+            repeat
+            )
+
+    return times
+
+
+def scaling(results):
+    """
+    scaling fits the slope of log(time) against log(number of houses)
+    of each benchmark, engine, vacancy rate and threshold
+
+    :param results: list of results of :func:`run`
+    :return: dict of "benchmark/engine/empty_house_rate/neighbour_similarity": slope
+    :rtype: dict
+    """
+    groups = {}
+    for r in results:
+        key = "{}/{}/{}/{}".format(
+            r["benchmark"], r["engine"], r["empty_house_rate"], r["neighbour_similarity"]
+            )
+        groups.setdefault(key, []).append((r["size"] ** 2, r["best"]))
+
+    slopes = {}
+    for key, points in groups.items():
+        if len(points) < 2:
+            continue
+        x = np.log([p[0] for p in points])
+        y = np.log([max(p[1], 1e-9) for p in points])
+        slopes[key] = round(float(np.polyfit(x, y, 1)[0]), 3)
+
+    return slopes
+
+
+def run(sizes, empty_house_rates, similarities, engines, repeat, seed = 0):
+    """
+    run times all the cases
+
+    :return: list of results, one per benchmark and case
+    :rtype: list
+    """
+    results = []
+    cases = itertools.product(engines, empty_house_rates, similarities, sizes)
+    for engine, empty_house_rate, neighbour_similarity, size in cases:
+        logger.info("{} {}x{} empty_house_rate={} neighbour_similarity={}".format(
+            engine, size, size, empty_house_rate, neighbour_similarity
+            ))
+        case_repeat = 1 if size * size >= LARGE_GRID else repeat
+        times = bench_case(
+            size, empty_house_rate, neighbour_similarity, engine, case_repeat, seed
+            )
+        for benchmark, t in times.items():
+            results.append({
+                "benchmark": benchmark,
+                "engine": engine,
+                "size": size,
+                "empty_house_rate": empty_house_rate,
+                "neighbour_similarity": neighbour_similarity,
+                "repeat": case_repeat,
+                "best": min(t),
+                "mean": statistics.mean(t)
+            })
+
+    return results
+
+
+def _commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL
+            ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline):
+    """
+    compare prints the ratio of the best times to the ones of a baseline,
+    above 1 is slower than the baseline
+    """
+    def key(r):
+        return (
+            r["benchmark"], r["engine"], r["size"],
+            r["empty_house_rate"], r["neighbour_similarity"]
+            )
+
+    old = {key(r): r for r in baseline["results"]}
+    print("{:<28} {:<6} {:>5} {:>5} {:>5} {:>12} {:>12} {:>7}".format(
+        "benchmark", "engine", "size", "empty", "sim", "baseline", "best", "ratio"
+        ))
+    for r in results:
+        o = old.get(key(r))
+        if o is None:
+            continue
+        print("{:<28} {:<6} {:>5} {:>5} {:>5} {:>12.6f} {:>12.6f} {:>7.2f}".format(
+            r["benchmark"], r["engine"], r["size"], r["empty_house_rate"],
+            r["neighbour_similarity"], o["best"], r["best"],
+            r["best"] / max(o["best"], 1e-12)
+            ))
+
+
+def main(args = None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES)
+    parser.add_argument("--empty-house-rates", type=float, nargs="+", default=EMPTY_HOUSE_RATES)
+    parser.add_argument("--similarities", type=float, nargs="+", default=SIMILARITIES)
+    parser.add_argument("--engines", nargs="+", choices=ENGINES, default=ENGINES)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="json file to save the results to")
+    parser.add_argument("--compare", help="json file of results to compare with")
+    args = parser.parse_args(args)
+
+    results = run(
+        args.sizes, args.empty_house_rates, args.similarities, args.engines,
+        args.repeat, args.seed
+        )
+    report = {
+        "commit": _commit(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "processor": platform.processor(),
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "results": results,
+        "scaling": scaling(results)
+    }
+
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=1)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+    else:
+        for key, slope in sorted(report["scaling"].items()):
+            print("{:<60} {:>6}".format(key, slope))
+
+
+if __name__ == "__main__":
+    main()
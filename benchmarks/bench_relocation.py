@@ -0,0 +1,131 @@
+"""
+Benchmarks of the relocation policies of the Schelling model.
+
+Runs the model to equilibrium with each relocation policy and reports the
+number of iterations and the wall time, which includes the extra work of
+looking at several empty houses per move::
+
+    python benchmarks/bench_relocation.py --output benchmarks/results/relocation.json
+
+A run that does not reach equilibrium in ``--iterations`` steps is
+reported with its stop reason.
+"""
+import argparse
+import itertools
+import json
+import logging
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app"))
+
+from models import Schelling  # noqa: E402
+
+logging.basicConfig()
+logger = logging.getLogger('benchmarks')
+logger.setLevel(logging.INFO)
+
+SIZES = [50, 100, 200]
+SIMILARITIES = [0.3, 0.5, 0.7]
+RELOCATIONS = ["random", "best_of_k", "nearest"]
+
+
+def run_case(size, neighbour_similarity, relocation, relocation_k, n_iterations, seed):
+    """
+    run_case runs one model until it stops
+
+    :return: iterations, stop reason, final order parameter and wall time
+    :rtype: dict
+    """
+    start = time.perf_counter()
+    model = Schelling(
+        {
+            "width": size,
+            "height": size,
+            "neighbour_similarity": neighbour_similarity,
+            "n_iterations": n_iterations,
+            "schedule": "frontier",
+            "relocation": relocation,
+            "relocation_k": relocation_k,
+            "seed": seed
+        },
+        engine="numpy"
+        )
+    model.initialize()
+    model.evolve(record="stats")
+
+    return {
+        "iterations": model.current_iteration,
+        "stop_reason": model.stop_reason,
+        "order_parameter": model.order_parameters[-1],
+        "wall_time": time.perf_counter() - start
+    }
+
+
+def run(sizes, similarities, relocations, relocation_k, n_iterations, replicates):
+    """
+    run runs all the cases
+
+    :return: list of results, one per case, averaged over the replicates
+    :rtype: list
+    """
+    results = []
+    for size, neighbour_similarity, relocation in itertools.product(
+        sizes, similarities, relocations
+    ):
+        runs = [
+            run_case(size, neighbour_similarity, relocation, relocation_k, n_iterations, seed)
+            for seed in range(replicates)
+            ]
+        result = {
+            "size": size,
+            "neighbour_similarity": neighbour_similarity,
+            "relocation": relocation,
+            "relocation_k": relocation_k,
+            "replicates": replicates,
+            "iterations": statistics.mean(r["iterations"] for r in runs),
+            "equilibrium": sum(r["stop_reason"] == "equilibrium" for r in runs),
+            "order_parameter": statistics.mean(r["order_parameter"] for r in runs),
+            "wall_time": statistics.mean(r["wall_time"] for r in runs)
+        }
+        logger.info(result)
+        results.append(result)
+
+    return results
+
+
+def main(args = None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES)
+    parser.add_argument("--similarities", type=float, nargs="+", default=SIMILARITIES)
+    parser.add_argument("--relocations", nargs="+", choices=RELOCATIONS, default=RELOCATIONS)
+    parser.add_argument("--relocation-k", type=int, default=16)
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--replicates", type=int, default=3)
+    parser.add_argument("--output", help="json file to save the results to")
+    args = parser.parse_args(args)
+
+    results = run(
+        args.sizes, args.similarities, args.relocations, args.relocation_k,
+        args.iterations, args.replicates
+        )
+
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, "w") as f:
+            json.dump({"results": results}, f, indent=1)
+
+    print("{:>5} {:>5} {:<10} {:>10} {:>11} {:>8} {:>10}".format(
+        "size", "sim", "relocation", "iterations", "equilibrium", "order", "wall time"
+        ))
+    for r in results:
+        print("{:>5} {:>5} {:<10} {:>10.1f} {:>8}/{:<2} {:>8.3f} {:>10.3f}".format(
+            r["size"], r["neighbour_similarity"], r["relocation"], r["iterations"],
+            r["equilibrium"], r["replicates"], r["order_parameter"], r["wall_time"]
+            ))
+
+
+if __name__ == "__main__":
+    main()